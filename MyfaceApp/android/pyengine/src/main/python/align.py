@@ -1,20 +1,36 @@
 # align.py
+import os
 import cv2
 import numpy as np
-import torch
-# vendored MTCNN lives under python/facenet_pytorch/mtcnn.py
-from facenet_pytorch import MTCNN
 
-mtcnn = MTCNN(image_size=112, margin=0)
+# Same switch as embed.py: FACEAUTH_PRECISION=bf16 (or fp16) runs the MTCNN nets in that dtype
+PRECISION = os.environ.get("FACEAUTH_PRECISION", "fp32")
+
+_mtcnn = None
+
+
+def _get_mtcnn():
+    # Built on first use rather than at import, so loading this module stays cheap.
+    # vendored MTCNN lives under python/facenet_pytorch/mtcnn.py; its nets are
+    # shared through the process-wide model registry.
+    global _mtcnn
+    if _mtcnn is None:
+        from facenet_pytorch import MTCNN
+        # only the largest face is used, so stop the pyramid once it is found
+        _mtcnn = MTCNN(image_size=112, margin=0, frozen=True, single_face=True,
+                       precision=PRECISION)
+    return _mtcnn
 
 def align_face(src):
+    import torch
+
     if isinstance(src, str):
         img = cv2.imread(src)
         if img is None:
             raise FileNotFoundError(f"Cannot read {src}")
     else:
         img = src
-    aligned = mtcnn(img)
+    aligned = _get_mtcnn()(img)
     if aligned is None:
         raise RuntimeError("No face detected")
     if isinstance(aligned, torch.Tensor):
@@ -1,50 +1,97 @@
 import os
-import torch
 import numpy as np
 import cv2
-from torchvision import transforms
-from PIL import Image
-from mobilefacenet import MobileFaceNet  # your copied backbone
-
-# Pick GPU if available
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 # -- INSERT THESE LINES AT THE TOP: -----------------------
 # base dir is the folder containing this file (embed.py)
 _BASE_DIR = os.path.dirname(__file__)
 MODEL_PATH = os.path.join(_BASE_DIR, "models", "MFN_AdaArcDistill_backbone.pth")
-if not os.path.isfile(MODEL_PATH):
-    raise FileNotFoundError(f"Model file not found at {MODEL_PATH!r}")
+# int8 model written by quantize_model.py --model android
+INT8_MODEL_PATH = os.path.join(_BASE_DIR, "models", "MFN_AdaArcDistill_backbone.int8.pt")
+# Set FACEAUTH_QUANTIZED=1 to embed with the int8 model instead of fp32
+QUANTIZED = os.environ.get("FACEAUTH_QUANTIZED", "0") == "1"
+if QUANTIZED:
+    MODEL_PATH = INT8_MODEL_PATH
+# Set FACEAUTH_PRECISION=bf16 (or fp16) to run the fp32 model in reduced precision;
+# ignored with FACEAUTH_QUANTIZED=1
+PRECISION = os.environ.get("FACEAUTH_PRECISION", "fp32")
 # -----------------------------------------------------------
 
-# Build model & load the AdaArcDistill weights
-model = MobileFaceNet(input_size=(112,112), embedding_size=512, output_name="GDC").to(device)
+# torch and the model are loaded on the first get_embedding() call, not at import,
+# so importing this module (and face_module) stays fast on app launch.
+device = None
+
+
+def _build_model():
+    import torch
+    from mobilefacenet import MobileFaceNet  # your copied backbone
+
+    # Build model & load the AdaArcDistill weights
+    net = MobileFaceNet(input_size=(112,112), embedding_size=512, output_name="GDC")
+
+    # now load from the absolute path
+    ckpt = torch.load(MODEL_PATH, map_location="cpu")
+
+    # strip any "module." prefixes if needed
+    state = {k.replace("module.",""): v for k, v in ckpt.items()}
+    net.load_state_dict(state)
+    return net.eval()
+
 
-# now load from the absolute path
-ckpt = torch.load(MODEL_PATH, map_location=device)
+def _get_model():
+    global device
+    import torch
+    from facenet_pytorch.models.utils import registry
 
-# strip any "module." prefixes if needed
-state = {k.replace("module.",""): v for k, v in ckpt.items()}
-model.load_state_dict(state)
-model.eval()
+    if not os.path.isfile(MODEL_PATH):
+        raise FileNotFoundError(f"Model file not found at {MODEL_PATH!r}")
+
+    if QUANTIZED:
+        # quantized kernels are CPU-only
+        from facenet_pytorch.models.utils.quantize import load_quantized
+        device = torch.device("cpu")
+        return registry.get_model("mobilefacenet_gdc", lambda: load_quantized(MODEL_PATH),
+                                  weights=MODEL_PATH, precision="int8", backend="frozen")
+
+    # Pick GPU if available
+    from facenet_pytorch.models.utils.freeze import load_frozen
+    from facenet_pytorch.models.utils.precision import (
+        frozen_name, mark_input_dtype, precision_dtype
+    )
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = precision_dtype(PRECISION)
+
+    import mobilefacenet
+
+    def load():
+        net = load_frozen(frozen_name("mobilefacenet_gdc", PRECISION), lambda: _build_model().to(dtype),
+                          torch.zeros(1, 3, 112, 112, dtype=dtype), [MODEL_PATH], device=device,
+                          sources=[mobilefacenet])
+        return mark_input_dtype(net, PRECISION)
+
+    # Load the frozen TorchScript artifact (rebuilt automatically when the weights or the
+    # mobilefacenet.py code change)
+    return registry.get_model("mobilefacenet_gdc", load, weights=MODEL_PATH, device=device,
+                              precision=PRECISION, backend="frozen")
 
-# Preprocessing: to tensor and normalize to [-1,1]
-_preprocess = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.5]*3, std=[0.5]*3),
-])
 
 def get_embedding(face_bgr: np.ndarray) -> np.ndarray:
     """
     face_bgr: uint8 H×W×3 BGR numpy array (112×112)
     Returns: 512-d L2-normalized embedding (float32 numpy)
     """
+    import torch
+
+    model = _get_model()
     # BGR→RGB
     face_rgb = cv2.cvtColor(face_bgr, cv2.COLOR_BGR2RGB)
-    img = Image.fromarray(face_rgb)  # PIL expects H×W×3 RGB uint8
-    x = _preprocess(img).unsqueeze(0).to(device)  # [1,3,112,112]
+    # to tensor and normalize to [-1,1] (same ops as ToTensor + Normalize(0.5, 0.5))
+    x = torch.from_numpy(face_rgb).permute(2, 0, 1).contiguous().float().div(255)
+    x = x.sub(0.5).div(0.5).unsqueeze(0)  # [1,3,112,112]
+    # the int8 model takes float32 input
+    x = x.to(device, getattr(model, "input_dtype", torch.float32))
     with torch.no_grad():
         emb = model(x)                          # [1,512]
-    emb = emb.cpu().numpy().flatten()
+    emb = emb.float().cpu().numpy().flatten()
     emb /= np.linalg.norm(emb)
     return emb
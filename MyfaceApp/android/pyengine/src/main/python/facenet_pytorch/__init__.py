@@ -1,11 +1,45 @@
-from .models.inception_resnet_v1 import InceptionResnetV1
-from .models.mtcnn import MTCNN, PNet, RNet, ONet, prewhiten, fixed_image_standardization
-from .models.utils.detect_face import extract_face
-from .models.utils import training
-
+import importlib
 import warnings
+
+# Public names are resolved lazily on first access, so importing the package (or only the
+# detector) does not pull in InceptionResnetV1, the training utilities or torch itself.
+_MODULES = ('training', 'profiling')
+_LAZY_ATTRS = {
+    'InceptionResnetV1': '.models.inception_resnet_v1',
+    'MTCNN': '.models.mtcnn',
+    'DETECTION_PRESETS': '.models.mtcnn',
+    'FaceTracker': '.models.tracker',
+    'PNet': '.models.mtcnn',
+    'RNet': '.models.mtcnn',
+    'ONet': '.models.mtcnn',
+    'prewhiten': '.models.mtcnn',
+    'fixed_image_standardization': '.models.mtcnn',
+    'extract_face': '.models.utils.detect_face',
+    'extract_faces': '.models.utils.detect_face',
+    'BackgroundWriter': '.models.utils.writer',
+    'BatchDetections': '.models.utils.detect_face',
+    'training': '.models.utils.training',
+    'profiling': '.models.utils.profiling',
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    module = importlib.import_module(_LAZY_ATTRS[name], __name__)
+    value = module if name in _MODULES else getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
 warnings.filterwarnings(
     action="ignore", 
     message="This overload of nonzero is deprecated:\n\tnonzero()", 
     category=UserWarning
-)
\ No newline at end of file
+)
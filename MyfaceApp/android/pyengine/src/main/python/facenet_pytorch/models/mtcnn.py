@@ -1,9 +1,22 @@
 import torch
 from torch import nn
 import numpy as np
+import copy
 import os
 
-from .utils.detect_face import detect_face, extract_face
+from .utils.detect_face import (
+    detect_face, detect_largest_face, detect_tiled, extract_faces, get_size, PlanCache,
+    BatchDetections
+)
+from .utils.freeze import load_frozen
+from .utils.onnx_backend import load_onnx
+from .utils.precision import frozen_name, mark_input_dtype, precision_dtype
+from .utils.profiling import span
+from .utils import registry
+
+
+def _state_dict_path(name):
+    return os.path.join(os.path.dirname(__file__), '../data/{}.pt'.format(name))
 
 
 class PNet(nn.Module):
@@ -30,8 +43,7 @@ class PNet(nn.Module):
         self.training = False
 
         if pretrained:
-            state_dict_path = os.path.join(os.path.dirname(__file__), '../data/pnet.pt')
-            state_dict = torch.load(state_dict_path)
+            state_dict = torch.load(_state_dict_path('pnet'))
             self.load_state_dict(state_dict)
 
     def forward(self, x):
@@ -75,8 +87,7 @@ class RNet(nn.Module):
         self.training = False
 
         if pretrained:
-            state_dict_path = os.path.join(os.path.dirname(__file__), '../data/rnet.pt')
-            state_dict = torch.load(state_dict_path)
+            state_dict = torch.load(_state_dict_path('rnet'))
             self.load_state_dict(state_dict)
 
     def forward(self, x):
@@ -128,8 +139,7 @@ class ONet(nn.Module):
         self.training = False
 
         if pretrained:
-            state_dict_path = os.path.join(os.path.dirname(__file__), '../data/onet.pt')
-            state_dict = torch.load(state_dict_path)
+            state_dict = torch.load(_state_dict_path('onet'))
             self.load_state_dict(state_dict)
 
     def forward(self, x):
@@ -154,6 +164,122 @@ class ONet(nn.Module):
         return b, c, a
 
 
+# name: (class, input side, output names, dynamic spatial axes)
+_NETS = {
+    'pnet': (PNet, 12, ['reg', 'prob'], True),
+    'rnet': (RNet, 24, ['reg', 'prob'], False),
+    'onet': (ONet, 48, ['reg', 'landmarks', 'prob'], False),
+}
+
+
+def load_net(name, backend='torch', device=None, rebuild=False, precision='fp32',
+             **session_options):
+    """Load one of 'pnet', 'rnet' or 'onet' for the given backend.
+
+    Arguments:
+        name {str} -- Which net to load.
+
+    Keyword Arguments:
+        backend {str} -- 'torch' (eager), 'frozen' (TorchScript artifact compiled if missing or
+            stale) or 'onnx' (ONNX Runtime session exported if missing or stale). (default: {'torch'})
+        device {torch.device} -- Device for the torch backends. (default: {None})
+        rebuild {bool} -- Force recompilation/re-export. (default: {False})
+        precision {str} -- 'fp32', 'bf16' or 'fp16' weights and activations, torch backends
+            only. Reduced-precision frozen nets are compiled to their own artifact.
+            (default: {'fp32'})
+        **session_options -- Passed to OnnxNet for the 'onnx' backend.
+    """
+    net_cls, size, outputs, dynamic = _NETS[name]
+    dtype = precision_dtype(precision)
+    if backend == 'onnx':
+        if precision != 'fp32':
+            raise ValueError("The 'onnx' backend only runs fp32 nets, got {!r}".format(precision))
+        # PNet gets dynamic spatial axes so a single session serves every pyramid scale
+        example = torch.rand(1, 3, 48, 64) if dynamic else torch.rand(4, 3, size, size)
+        return load_onnx(
+            name, net_cls, example, [_state_dict_path(name)], outputs,
+            dynamic_spatial=dynamic, rebuild=rebuild, sources=[net_cls], **session_options
+        )
+    if backend == 'frozen':
+        net = load_frozen(
+            frozen_name(name, precision), lambda: net_cls().to(dtype),
+            torch.zeros(1, 3, size, size, dtype=dtype), [_state_dict_path(name)],
+            device=device, rebuild=rebuild, sources=[net_cls]
+        )
+        return mark_input_dtype(net, precision)
+    net = net_cls().to(dtype)
+    return net if device is None else net.to(device)
+
+
+def load_frozen_nets(device=None, rebuild=False):
+    """Load frozen TorchScript P-, R- and O-nets, compiling them if missing or stale.
+
+    Keyword Arguments:
+        device {torch.device} -- Device to map the nets to. (default: {None})
+        rebuild {bool} -- Force recompilation of the artifacts. (default: {False})
+
+    Returns:
+        tuple(torch.jit.ScriptModule) -- Frozen pnet, rnet and onet.
+    """
+    return tuple(load_net(name, 'frozen', device, rebuild) for name in _NETS)
+
+
+def load_onnx_nets(rebuild=False, **session_options):
+    """Load P-, R- and O-nets as ONNX Runtime sessions, exporting them if missing or stale.
+
+    Keyword Arguments:
+        rebuild {bool} -- Force a new export. (default: {False})
+        **session_options -- Passed to OnnxNet, e.g. intra_op_num_threads and
+            graph_optimization_level.
+
+    Returns:
+        tuple(OnnxNet) -- pnet, rnet and onet sessions.
+    """
+    return tuple(load_net(name, 'onnx', rebuild=rebuild, **session_options) for name in _NETS)
+
+
+def get_detector_nets(device=None, backend='torch', onnx_options=None, precision='fp32'):
+    """Shared P-, R- and O-nets from the process-wide model registry.
+
+    Each net is loaded once per (device, backend, precision, options) and reused by every MTCNN
+    instance in the process, so creating several detectors costs no extra loads or memory.
+
+    Keyword Arguments:
+        device {torch.device} -- Device for the torch backends. (default: {None, CPU})
+        backend {str} -- 'torch', 'frozen' or 'onnx'. (default: {'torch'})
+        onnx_options {dict} -- Session options for the 'onnx' backend. (default: {None})
+        precision {str} -- 'fp32', 'bf16' or 'fp16', see load_net. (default: {'fp32'})
+
+    Returns:
+        tuple -- pnet, rnet and onet.
+    """
+    onnx_options = onnx_options or {}
+    if backend == 'onnx':
+        device = None
+    return tuple(
+        registry.get_model(
+            name,
+            lambda name=name: load_net(name, backend, device, precision=precision, **onnx_options),
+            weights=_state_dict_path(name), device=device or 'cpu', precision=precision,
+            backend=backend, options=onnx_options
+        )
+        for name in _NETS
+    )
+
+
+# Named detection settings for common capture setups. face_size_range is relative to the
+# image's short side and prunes pyramid levels that cannot contain an expected face.
+DETECTION_PRESETS = {
+    # Enrollment and verification selfies: one face filling a large part of the frame
+    'selfie': {'min_face_size': 40, 'max_face_size': None, 'face_size_range': (0.2, 1.0)},
+    'enrollment': {'min_face_size': 40, 'max_face_size': None, 'face_size_range': (0.2, 1.0)},
+    # Access-control camera: one or a few people at a known distance from the lens
+    'turnstile': {'min_face_size': 32, 'max_face_size': None, 'face_size_range': (0.08, 0.6)},
+    # Wide shots with many small faces
+    'crowd': {'min_face_size': 16, 'max_face_size': None, 'face_size_range': (None, 0.3)},
+}
+
+
 class MTCNN(nn.Module):
     """MTCNN face detection module.
 
@@ -161,8 +287,9 @@ class MTCNN(nn.Module):
     only, given raw input images of one of the following types:
         - PIL image or list of PIL images
         - numpy.ndarray (uint8) representing either a single image (3D) or a batch of images (4D).
-    Cropped faces can optionally be saved to file
-    also.
+    Lists may mix image sizes: similar sizes are padded into shared batches (see
+    utils.detect_face.detect_buckets) and results come back in input order. Cropped faces can optionally be saved to file
+    also. Detection stages are timed while a utils.profiling profile is active.
     
     Keyword Arguments:
         image_size {int} -- Output image size in pixels. The image will be square. (default: {160})
@@ -172,6 +299,38 @@ class MTCNN(nn.Module):
             dependent on the original image size (this is a bug in davidsandberg/facenet).
             (default: {0})
         min_face_size {int} -- Minimum face size to search for. (default: {20})
+        max_face_size {int} -- Maximum face size to search for; coarser pyramid levels are
+            skipped. (default: {None, up to the image's short side})
+        face_size_range {tuple} -- Expected (min, max) face size as a fraction of the image's
+            short side. Pyramid levels outside the range are skipped; either end may be None.
+            (default: {None})
+        preset {str} -- Named detection settings from DETECTION_PRESETS ('selfie',
+            'enrollment', 'turnstile' or 'crowd'). Replaces min_face_size, max_face_size and
+            face_size_range. (default: {None})
+        single_face {bool} -- If True, detect() searches the pyramid from the largest faces down
+            and stops once each image has a face at least as large as anything the remaining
+            levels could find (see detect_largest_face). Only the faces found up to that point
+            are returned, so use it when only the largest face is needed. (default: {False})
+        packed_pyramid {bool} -- If True, all pyramid levels are tiled into one canvas and PNet
+            runs once per batch instead of once per level (see pack_pyramid). This trades
+            per-call overhead for ~15% more PNet pixels, so it pays off where launches are
+            expensive (GPUs, small images); measure with benchmarks.packed_pyramid. Ignored
+            when single_face=True. (default: {False})
+        pyramid {str} -- Backend that builds the PNet image pyramid: 'torch' resamples every
+            level from the full image as float, 'cv2' keeps the image as uint8 and builds each
+            level from the previous one with cv2.resize(INTER_AREA), which is much cheaper on
+            CPU at the cost of slightly different boxes. (default: {'torch'})
+        max_memory_mb {float} -- Peak detection memory budget per image, in MB. Images whose
+            estimated working memory exceeds it are detected in overlapping tiles (small faces)
+            plus a downscaled full image (large faces), see detect_tiled; single_face then only
+            applies to images within the budget. (default: {None, no limit})
+        plan_cache_size {int} -- Number of detection plans (pyramid scales and level sizes plus
+            the image, summed-area table and packed canvas buffers) kept for the most recently
+            seen image resolutions and reused by later calls, see PlanCache (each plan keeps at
+            most 64 MB of buffers). 0 or None disables the cache. (default: {8})
+        writer {BackgroundWriter} -- If given, face crops requested with `save_path` are written
+            on its threads instead of before forward() returns; call writer.flush() to wait for
+            them. (default: {None})
         thresholds {list} -- MTCNN face detection thresholds (default: {[0.6, 0.7, 0.7]})
         factor {float} -- Factor used to create a scaling pyramid of face sizes. (default: {0.709})
         post_process {bool} -- Whether or not to post process images tensors before returning.
@@ -192,18 +351,61 @@ class MTCNN(nn.Module):
             (default: {False})
         device {torch.device} -- The device on which to run neural net passes. Image tensors and
             models are copied to this device before running forward passes. (default: {None})
+        frozen {bool} -- If True, P-, R- and O-nets are loaded from frozen TorchScript artifacts
+            cached on disk (see models.utils.freeze), compiling them on first use or whenever the
+            weights change. Frozen nets cannot be cast with .half()/.double(). (default: {False})
+        backend {str} -- 'torch' to run the nets with PyTorch, or 'onnx' to run them in ONNX
+            Runtime sessions (CPU), exporting them on first use. (default: {'torch'})
+        onnx_options {dict} -- Session options for the 'onnx' backend: intra_op_num_threads,
+            inter_op_num_threads, graph_optimization_level ('disable', 'basic', 'extended',
+            'all') and providers. (default: {None})
+        precision {str} -- 'fp32', 'bf16' or 'fp16'. The P-, R- and O-nets run in that dtype
+            (torch and frozen backends); the image pyramid, crops, box regression and NMS stay
+            in float32 and only the net inputs are cast. bf16 is faster on CPUs with bf16
+            support; fp16 mainly pays off on GPUs. (default: {'fp32'})
+        shared {bool} -- If True, the nets come from the process-wide model registry and are
+            shared with every other MTCNN using the same device, backend and precision, so
+            weights are loaded once per process. Casting or moving the instance (.double(),
+            .half(), .to()) first gives it private copies of the nets, leaving the shared ones
+            untouched. (default: {True})
     """
 
     def __init__(
         self, image_size=160, margin=0, min_face_size=20,
         thresholds=[0.6, 0.7, 0.7], factor=0.709, post_process=True,
-        select_largest=True, selection_method=None, keep_all=False, device=None
+        select_largest=True, selection_method=None, keep_all=False, device=None,
+        frozen=False, backend='torch', onnx_options=None, shared=True,
+        max_face_size=None, face_size_range=None, preset=None, single_face=False,
+        packed_pyramid=False, pyramid='torch', max_memory_mb=None, plan_cache_size=8,
+        writer=None, precision='fp32'
     ):
         super().__init__()
 
+        if preset is not None:
+            if preset not in DETECTION_PRESETS:
+                raise ValueError('Unknown detection preset {!r}, expected one of {}'.format(
+                    preset, ', '.join(DETECTION_PRESETS)
+                ))
+            min_face_size = DETECTION_PRESETS[preset]['min_face_size']
+            max_face_size = DETECTION_PRESETS[preset]['max_face_size']
+            face_size_range = DETECTION_PRESETS[preset]['face_size_range']
+        if pyramid not in ('torch', 'cv2'):
+            raise ValueError("pyramid must be 'torch' or 'cv2', got {!r}".format(pyramid))
+        precision_dtype(precision)
+
         self.image_size = image_size
         self.margin = margin
         self.min_face_size = min_face_size
+        self.max_face_size = max_face_size
+        self.face_size_range = face_size_range
+        self.preset = preset
+        self.single_face = single_face
+        self.packed_pyramid = packed_pyramid
+        self.pyramid = pyramid
+        self.max_memory_mb = max_memory_mb
+        self.plan_cache = PlanCache(plan_cache_size) if plan_cache_size else None
+        self.writer = writer
+        self.precision = precision
         self.thresholds = thresholds
         self.factor = factor
         self.post_process = post_process
@@ -211,18 +413,39 @@ class MTCNN(nn.Module):
         self.keep_all = keep_all
         self.selection_method = selection_method
 
-        self.pnet = PNet()
-        self.rnet = RNet()
-        self.onet = ONet()
+        if backend == 'torch' and frozen:
+            backend = 'frozen'
+        # only eager nets have parameters that a cast or move would change in place
+        self._shared_nets = shared and backend == 'torch'
+        if shared:
+            self.pnet, self.rnet, self.onet = get_detector_nets(
+                device, backend, onnx_options, precision
+            )
+        else:
+            self.pnet, self.rnet, self.onet = (
+                load_net(name, backend, device, precision=precision, **(onnx_options or {}))
+                for name in _NETS
+            )
 
         self.device = torch.device('cpu')
         if device is not None:
             self.device = device
-            self.to(device)
+            if not shared:      # registry nets are already loaded on `device`
+                self.to(device)
 
         if not self.selection_method:
             self.selection_method = 'largest' if self.select_largest else 'probability'
 
+    def _apply(self, fn, *args, **kwargs):
+        # .to(), .double(), .half() etc. all end up here: swap registry-shared nets for private
+        # copies first, so the cast does not reach every other MTCNN sharing them
+        if self._shared_nets:
+            self.pnet, self.rnet, self.onet = (
+                copy.deepcopy(net) for net in (self.pnet, self.rnet, self.onet)
+            )
+            self._shared_nets = False
+        return super()._apply(fn, *args, **kwargs)
+
     def forward(self, img, save_path=None, return_prob=False):
         """Run MTCNN face detection on a PIL image or numpy array. This method performs both
         detection and extraction of faces, returning tensors representing detected faces rather
@@ -258,18 +481,20 @@ class MTCNN(nn.Module):
         batch_boxes, batch_probs, batch_points = self.detect(img, landmarks=True)
         # Select faces
         if not self.keep_all:
-            batch_boxes, batch_probs, batch_points = self.select_boxes(
-                batch_boxes, batch_probs, batch_points, img, method=self.selection_method
-            )
+            with span('select'):
+                batch_boxes, batch_probs, batch_points = self.select_boxes(
+                    batch_boxes, batch_probs, batch_points, img, method=self.selection_method
+                )
         # Extract faces
-        faces = self.extract(img, batch_boxes, save_path)
+        with span('extract'):
+            faces = self.extract(img, batch_boxes, save_path)
 
         if return_prob:
             return faces, batch_probs
         else:
             return faces
 
-    def detect(self, img, landmarks=False):
+    def detect(self, img, landmarks=False, stats=None):
         """Detect all faces in PIL image and return bounding boxes and optional facial landmarks.
 
         This method is used by the forward method and is also useful for face detection tasks
@@ -283,6 +508,12 @@ class MTCNN(nn.Module):
         Keyword Arguments:
             landmarks {bool} -- Whether to return facial landmarks in addition to bounding boxes.
                 (default: {False})
+            stats {dict} -- If given, filled with the work done: 'scales' (pyramid levels run
+                through PNet), 'pnet_pixels' (pixels fed to PNet over all levels and images) and
+                'face_sizes' ([smallest, largest] face size searched, in pixels). With
+                single_face=True it also holds 'early_exit', whether finer levels were skipped.
+                For a list of mixed-size images, 'scales' and 'pnet_pixels' are summed over
+                the padded batches and 'buckets' holds their number. (default: {None})
         
         Returns:
             tuple(numpy.ndarray, list) -- For N detected faces, a tuple containing an
@@ -309,36 +540,7 @@ class MTCNN(nn.Module):
         >>> img_draw.save('annotated_faces.png')
         """
 
-        with torch.no_grad():
-            batch_boxes, batch_points = detect_face(
-                img, self.min_face_size,
-                self.pnet, self.rnet, self.onet,
-                self.thresholds, self.factor,
-                self.device
-            )
-
-        boxes, probs, points = [], [], []
-        for box, point in zip(batch_boxes, batch_points):
-            box = np.array(box)
-            point = np.array(point)
-            if len(box) == 0:
-                boxes.append(None)
-                probs.append([None])
-                points.append(None)
-            elif self.select_largest:
-                box_order = np.argsort((box[:, 2] - box[:, 0]) * (box[:, 3] - box[:, 1]))[::-1]
-                box = box[box_order]
-                point = point[box_order]
-                boxes.append(box[:, :4])
-                probs.append(box[:, 4])
-                points.append(point)
-            else:
-                boxes.append(box[:, :4])
-                probs.append(box[:, 4])
-                points.append(point)
-        boxes = np.array(boxes, dtype=object)
-        probs = np.array(probs, dtype=object)
-        points = np.array(points, dtype=object)
+        boxes, probs, points = self.detect_batch(img, stats=stats).to_detect()
 
         if (
             not isinstance(img, (list, tuple)) and 
@@ -354,6 +556,59 @@ class MTCNN(nn.Module):
 
         return boxes, probs
 
+    def detect_batch(self, img, stats=None):
+        """Detect all faces in a batch of images, in one flat BatchDetections.
+
+        Unlike detect(), which builds per-image object arrays, the faces of every image are
+        returned in flat boxes, probs and points arrays, with per-image row offsets. With
+        select_largest=True each image's faces are ordered largest first.
+
+        Arguments:
+            img {PIL.Image, np.ndarray, or list} -- A PIL image, np.ndarray, torch.Tensor, or list.
+
+        Keyword Arguments:
+            stats {dict} -- Filled as by detect(). (default: {None})
+
+        Returns:
+            BatchDetections -- Faces of each image, also for a single image (a batch of one).
+
+        Example:
+        >>> detections = mtcnn.detect_batch(frames)
+        >>> for i in range(len(detections)):
+        ...     boxes, probs, points = detections[i]
+        """
+        if self.single_face:
+            detect_fn, options = detect_largest_face, {'pyramid': self.pyramid}
+        else:
+            detect_fn, options = detect_face, {'packed': self.packed_pyramid, 'pyramid': self.pyramid}
+        options['plan_cache'] = self.plan_cache
+        if self.max_memory_mb is not None:
+            detect_fn, options = detect_tiled, dict(
+                options, detect_fn=detect_fn, max_memory_mb=self.max_memory_mb
+            )
+        with span('detect'), torch.no_grad():
+            detections = detect_fn(
+                img, self.min_face_size,
+                self.pnet, self.rnet, self.onet,
+                self.thresholds, self.factor,
+                self.device, max_face_size=self.max_face_size,
+                face_size_range=self.face_size_range, stats=stats, compact=True, **options
+            )
+
+            if self.select_largest:
+                detections = detections.largest_first()
+        return detections
+
+    def plan_cache_info(self):
+        """Hits, misses and evictions of the detection plan cache, or None without one.
+
+        Returns:
+            PlanCacheInfo -- (hits, misses, evictions, maxsize, currsize)
+        """
+        if self.plan_cache is None:
+            return None
+        return self.plan_cache.info()
+
     def select_boxes(
         self, all_boxes, all_probs, all_points, imgs, method='probability', threshold=0.9,
         center_weight=2.0
@@ -398,53 +653,26 @@ class MTCNN(nn.Module):
             all_points = [all_points]
             batch_mode = False
 
-        selected_boxes, selected_probs, selected_points = [], [], []
-        for boxes, points, probs, img in zip(all_boxes, all_points, all_probs, imgs):
-            
-            if boxes is None:
-                selected_boxes.append(None)
-                selected_probs.append([None])
-                selected_points.append(None)
-                continue
-            
-            # If at least 1 box found
-            boxes = np.array(boxes)
-            probs = np.array(probs)
-            points = np.array(points)
-                
-            if method == 'largest':
-                box_order = np.argsort((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))[::-1]
-            elif method == 'probability':
-                box_order = np.argsort(probs)[::-1]
-            elif method == 'center_weighted_size':
-                box_sizes = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
-                img_center = (img.width / 2, img.height/2)
-                box_centers = np.array(list(zip((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2)))
-                offsets = box_centers - img_center
-                offset_dist_squared = np.sum(np.power(offsets, 2.0), 1)
-                box_order = np.argsort(box_sizes - offset_dist_squared * center_weight)[::-1]
-            elif method == 'largest_over_threshold':
-                box_mask = probs > threshold
-                boxes = boxes[box_mask]
-                box_order = np.argsort((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))[::-1]
-                if sum(box_mask) == 0:
-                    selected_boxes.append(None)
-                    selected_probs.append([None])
-                    selected_points.append(None)
-                    continue
-
-            box = boxes[box_order][[0]]
-            prob = probs[box_order][[0]]
-            point = points[box_order][[0]]
-            selected_boxes.append(box)
-            selected_probs.append(prob)
-            selected_points.append(point)
-
-        if batch_mode:
-            selected_boxes = np.array(selected_boxes)
-            selected_probs = np.array(selected_probs)
-            selected_points = np.array(selected_points)
+        detections = BatchDetections.from_detect(all_boxes, all_probs, all_points)
+        image_sizes = [get_size(img) for img in imgs] if method == 'center_weighted_size' else None
+        pick = detections.select(method, threshold, center_weight, image_sizes)
+
+        found = np.flatnonzero(pick >= 0)
+        boxes = detections.boxes[pick[found], None]
+        probs = detections.probs[pick[found], None]
+        points = detections.points[pick[found], None]
+        if len(found) == len(pick):
+            selected_boxes, selected_probs, selected_points = boxes, probs, points
         else:
+            # Images without a face get None, as from detect()
+            selected_boxes = np.empty(len(pick), dtype=object)
+            selected_points = np.empty(len(pick), dtype=object)
+            selected_probs = np.empty(len(pick), dtype=object)
+            selected_probs[:] = [[None]] * len(pick)
+            for j, i in enumerate(found):
+                selected_boxes[i], selected_probs[i], selected_points[i] = boxes[j], probs[j], points[j]
+
+        if not batch_mode:
             selected_boxes = selected_boxes[0]
             selected_probs = selected_probs[0][0]
             selected_points = selected_points[0]
@@ -480,21 +708,20 @@ class MTCNN(nn.Module):
             if not self.keep_all:
                 box_im = box_im[[0]]
 
-            faces_im = []
-            for i, box in enumerate(box_im):
-                face_path = path_im
-                if path_im is not None and i > 0:
-                    save_name, ext = os.path.splitext(path_im)
-                    face_path = save_name + '_' + str(i + 1) + ext
-
-                face = extract_face(im, box, self.image_size, self.margin, face_path)
-                if self.post_process:
-                    face = fixed_image_standardization(face)
-                faces_im.append(face)
-
-            if self.keep_all:
-                faces_im = torch.stack(faces_im)
-            else:
+            face_paths = None
+            if path_im is not None:
+                save_name, ext = os.path.splitext(path_im)
+                face_paths = [path_im] + [
+                    save_name + '_' + str(i + 1) + ext for i in range(1, len(box_im))
+                ]
+
+            faces_im = extract_faces(
+                im, box_im, self.image_size, self.margin, face_paths, self.writer
+            )
+            if self.post_process:
+                faces_im = fixed_image_standardization(faces_im)
+
+            if not self.keep_all:
                 faces_im = faces_im[0]
 
             faces.append(faces_im)
@@ -0,0 +1,134 @@
+import numpy as np
+import torch
+
+from .utils.detect_face import detect_face, batched_nms_torch
+
+
+class FaceTracker(object):
+    """Face detection for video streams that re-detects only around the previous faces.
+
+    The first frame, and every `redetect_every`-th frame after it, runs the full MTCNN pyramid.
+    In between, each tracked face is searched for in a window around its previous box, with the
+    pyramid limited to faces close to its previous size, so PNet, RNet and ONet only see a small
+    crop of the frame. If any tracked face is not found again with at least `min_prob`, the
+    frame falls back to full detection. New faces entering the frame are picked up at the next
+    full detection.
+
+    Arguments:
+        mtcnn {MTCNN} -- Detector whose nets, thresholds and options are used.
+
+    Keyword Arguments:
+        redetect_every {int} -- Run full detection at least every this many frames. (default: {15})
+        min_prob {float} -- Lowest face probability at which a tracked face is kept; below it
+            the frame is re-detected. (default: {0.9})
+        search_margin {float} -- Window around a tracked box, on each side, as a fraction of the
+            face size. (default: {0.5})
+        size_range {tuple} -- Face sizes searched for in the window, relative to the previous
+            face size. (default: {(0.7, 1.4)})
+
+    Example:
+    >>> tracker = FaceTracker(MTCNN())
+    >>> for frame in frames:
+    ...     boxes, probs = tracker.detect(frame)
+    """
+
+    def __init__(self, mtcnn, redetect_every=15, min_prob=0.9, search_margin=0.5, size_range=(0.7, 1.4)):
+        self.mtcnn = mtcnn
+        self.redetect_every = redetect_every
+        self.min_prob = min_prob
+        self.search_margin = search_margin
+        self.size_range = size_range
+        self.reset()
+
+    def reset(self):
+        """Forget the tracked faces, so the next frame runs full detection."""
+        self.boxes = None
+        self.frames_since_detection = 0
+
+    def detect(self, img, landmarks=False, stats=None):
+        """Detect faces in the next frame of the stream.
+
+        Arguments:
+            img {PIL.Image, np.ndarray, or torch.Tensor} -- A single H x W x 3 frame.
+
+        Keyword Arguments:
+            landmarks {bool} -- Whether to return facial landmarks. (default: {False})
+            stats {dict} -- If given, filled like MTCNN.detect's stats (summed over the search
+                windows when tracking) plus 'tracked', whether full detection was skipped.
+                (default: {None})
+
+        Returns:
+            tuple -- Same as MTCNN.detect() for a single image.
+        """
+        tracked = None
+        # this frame is the redetect_every-th since the last full detection
+        due = self.frames_since_detection + 1 >= self.redetect_every
+        if self.boxes is not None and not due:
+            tracked = self._track(img if isinstance(img, torch.Tensor) else np.asarray(img), stats)
+
+        if tracked is None:
+            boxes, probs, points = self.mtcnn.detect(img, landmarks=True, stats=stats)
+            self.frames_since_detection = 0
+        else:
+            boxes, probs, points = tracked
+            self.frames_since_detection += 1
+        self.boxes = None if boxes is None else np.asarray(boxes, dtype=np.float32)
+
+        if stats is not None:
+            stats['tracked'] = tracked is not None
+        if landmarks:
+            return boxes, probs, points
+        return boxes, probs
+
+    def _track(self, frame, stats=None):
+        """Find every tracked face near its previous box, or None if one of them is lost."""
+        mtcnn = self.mtcnn
+        h, w = frame.shape[:2]
+        low, high = self.size_range
+
+        found_boxes, found_points = [], []
+        window_stats = {'scales': 0, 'pnet_pixels': 0}
+        for box in self.boxes:
+            size = np.sqrt((box[2] - box[0]) * (box[3] - box[1]))
+            margin = self.search_margin * size
+            x1, y1 = int(max(box[0] - margin, 0)), int(max(box[1] - margin, 0))
+            x2, y2 = int(min(box[2] + margin, w)), int(min(box[3] + margin, h))
+            if min(x2 - x1, y2 - y1) < 12:
+                return None
+
+            window = {}
+            with torch.no_grad():
+                faces, probs, points = detect_face(
+                    frame[y1:y2, x1:x2], size * low,
+                    mtcnn.pnet, mtcnn.rnet, mtcnn.onet,
+                    mtcnn.thresholds, mtcnn.factor,
+                    mtcnn.device, max_face_size=size * high, stats=window,
+                    pyramid=mtcnn.pyramid, compact=True
+                )[0]
+            window_stats['scales'] += window['scales']
+            window_stats['pnet_pixels'] += window['pnet_pixels']
+
+            if len(faces) == 0:
+                return None
+            best = probs.argmax()
+            if probs[best] < self.min_prob:
+                return None
+            found_boxes.append(np.append(faces[best] + [x1, y1, x1, y1], probs[best]).astype(np.float32))
+            found_points.append((points[best] + [x1, y1]).astype(np.float32))
+
+        boxes, points = np.stack(found_boxes), np.stack(found_points)
+
+        # Neighbouring windows can lock on to the same face
+        boxes_t = torch.as_tensor(boxes)
+        pick = batched_nms_torch(
+            boxes_t[:, :4], boxes_t[:, 4], torch.zeros(len(boxes_t), dtype=torch.int64), 0.7, 'Min'
+        ).numpy()
+        boxes, points = boxes[pick], points[pick]
+
+        if mtcnn.select_largest:
+            order = np.argsort((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))[::-1]
+            boxes, points = boxes[order], points[order]
+
+        if stats is not None:
+            stats.update(window_stats)
+        return boxes[:, :4], boxes[:, 4], points
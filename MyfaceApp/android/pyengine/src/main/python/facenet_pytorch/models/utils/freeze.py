@@ -0,0 +1,134 @@
+import hashlib
+import inspect
+import os
+import tempfile
+
+import torch
+
+
+def get_frozen_home():
+    """Directory used to cache frozen TorchScript artifacts.
+
+    Defaults to <TORCH_HOME>/frozen and can be overridden with the FACENET_FROZEN_HOME
+    environment variable.
+    """
+    torch_home = os.path.expanduser(
+        os.getenv(
+            'TORCH_HOME',
+            os.path.join(os.getenv('XDG_CACHE_HOME', '~/.cache'), 'torch')
+        )
+    )
+    return os.path.expanduser(os.getenv('FACENET_FROZEN_HOME', os.path.join(torch_home, 'frozen')))
+
+
+def source_bytes(obj):
+    """Source code of a class, function or module, or its compiled file if the source is not
+    shipped (e.g. .pyc-only installs)."""
+    try:
+        return inspect.getsource(obj).encode()
+    except (OSError, TypeError):
+        with open(inspect.getfile(obj), 'rb') as f:
+            return f.read()
+
+
+def weights_hash(weights_paths, sources=()):
+    """SHA256 digest over one or more weight files, the torch version, the file names and the
+    source code of the model.
+
+    Arguments:
+        weights_paths {list} -- Paths of the state_dict files the model is built from.
+
+    Keyword Arguments:
+        sources {list} -- Classes or modules defining the model. Their source code is hashed,
+            so editing the model code invalidates artifacts built from the same weights.
+            (default: {()})
+
+    Returns:
+        str -- Hex digest identifying this exact set of weights and model code.
+    """
+    sha = hashlib.sha256()
+    sha.update(torch.__version__.encode())
+    for path in weights_paths:
+        sha.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    for obj in sources:
+        sha.update(source_bytes(obj))
+    return sha.hexdigest()
+
+
+def frozen_path(name, weights_paths, cache_dir=None, sources=()):
+    """Location of the frozen artifact for `name` built from the given weights and code."""
+    cache_dir = get_frozen_home() if cache_dir is None else cache_dir
+    digest = weights_hash(weights_paths, sources)[:16]
+    return os.path.join(cache_dir, '{}-{}.pt'.format(name, digest))
+
+
+def remove_stale(cache_dir, name, current, ext):
+    """Delete `name` artifacts in cache_dir other than `current`. Another process may be
+    cleaning up at the same time, so files that are already gone are ignored."""
+    prefix = name + '-'
+    for f in os.listdir(cache_dir):
+        if f.startswith(prefix) and f.endswith(ext) and f != os.path.basename(current):
+            try:
+                os.remove(os.path.join(cache_dir, f))
+            except FileNotFoundError:
+                pass
+
+
+def freeze_module(module, example_input):
+    """Trace and freeze an eval-mode module into a TorchScript module.
+
+    Arguments:
+        module {torch.nn.Module} -- Model with weights loaded.
+        example_input {torch.Tensor} -- Representative input used for tracing.
+
+    Returns:
+        torch.jit.ScriptModule -- Frozen module with weights folded in as constants.
+    """
+    module = module.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_input)
+    return torch.jit.freeze(traced)
+
+
+def load_frozen(name, build_fn, example_input, weights_paths, device=None, cache_dir=None,
+                rebuild=False, sources=()):
+    """Load a frozen TorchScript artifact, compiling and caching it if missing or stale.
+
+    Artifacts are keyed by a hash of the weight files and the model source code (`sources`),
+    so updating either triggers a rebuild on next load; once the new artifact is in place,
+    stale artifacts for the same model name are removed.
+
+    Arguments:
+        name {str} -- Model name used in the artifact filename.
+        build_fn {callable} -- Zero-argument function returning the eager model on the CPU
+            with its weights loaded. Only called when the artifact has to be (re)built.
+        example_input {torch.Tensor} -- Representative input used for tracing.
+        weights_paths {list} -- Weight files the model is built from.
+
+    Keyword Arguments:
+        device {torch.device} -- Device to map the loaded module to. (default: {None})
+        cache_dir {str} -- Artifact directory. (default: {get_frozen_home()})
+        rebuild {bool} -- Force recompilation even if a matching artifact exists.
+            (default: {False})
+        sources {list} -- Classes or modules defining the model, see weights_hash.
+            (default: {()})
+
+    Returns:
+        torch.jit.ScriptModule -- The frozen module.
+    """
+    cache_dir = get_frozen_home() if cache_dir is None else cache_dir
+    path = frozen_path(name, weights_paths, cache_dir, sources)
+
+    if rebuild or not os.path.exists(path):
+        frozen = freeze_module(build_fn(), example_input)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        torch.jit.save(frozen, tmp_path)
+        os.replace(tmp_path, path)
+        remove_stale(cache_dir, name, path, '.pt')
+
+    return torch.jit.load(path, map_location=device)
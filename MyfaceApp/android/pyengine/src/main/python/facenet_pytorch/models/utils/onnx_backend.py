@@ -0,0 +1,168 @@
+import inspect
+import os
+import tempfile
+
+import numpy as np
+import torch
+from torch import nn
+
+from .freeze import get_frozen_home, remove_stale, weights_hash
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+
+def onnx_path(name, weights_paths, cache_dir=None, sources=()):
+    """Location of the ONNX export for `name` built from the given weights and code."""
+    cache_dir = os.path.join(get_frozen_home(), 'onnx') if cache_dir is None else cache_dir
+    digest = weights_hash(weights_paths, sources)[:16]
+    return os.path.join(cache_dir, '{}-{}.onnx'.format(name, digest))
+
+
+def export_onnx(model, example_input, path, output_names, dynamic_spatial=False, opset=13):
+    """Export a model to ONNX with a dynamic batch axis.
+
+    Arguments:
+        model {torch.nn.Module} -- Eval-mode model with weights loaded.
+        example_input {torch.Tensor} -- Representative input used for tracing.
+        path {str} -- Destination .onnx file.
+        output_names {list} -- Names of the model outputs, in forward() order.
+
+    Keyword Arguments:
+        dynamic_spatial {bool} -- Also make input and output height/width dynamic (needed for
+            fully convolutional nets such as PNet). (default: {False})
+        opset {int} -- ONNX opset version. (default: {13})
+    """
+    dynamic_axes = {}
+    for name in ['input'] + list(output_names):
+        dynamic_axes[name] = {0: 'batch'}
+        if dynamic_spatial:
+            dynamic_axes[name].update({2: name + '_height', 3: name + '_width'})
+
+    # Newer torch releases default to the dynamo exporter, which cannot express these axes
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model.eval(), example_input, path,
+            input_names=['input'], output_names=list(output_names),
+            dynamic_axes=dynamic_axes, opset_version=opset, **kwargs
+        )
+
+
+class OnnxNet(nn.Module):
+    """Drop-in replacement for a torch net that runs an ONNX Runtime session.
+
+    Inputs are torch tensors and outputs are returned as torch tensors on the input's device,
+    so instances can be passed to detect_face() or used as MTCNN/MobileFaceNet models.
+
+    Arguments:
+        path {str} -- Path of the .onnx file.
+
+    Keyword Arguments:
+        intra_op_num_threads {int} -- Threads used within an operator. (default: {None, ORT default})
+        inter_op_num_threads {int} -- Threads used across operators. (default: {None, ORT default})
+        graph_optimization_level {str} -- One of 'disable', 'basic', 'extended' or 'all'.
+            (default: {'all'})
+        providers {list} -- ONNX Runtime execution providers. (default: {['CPUExecutionProvider']})
+    """
+
+    def __init__(
+        self, path, intra_op_num_threads=None, inter_op_num_threads=None,
+        graph_optimization_level='all', providers=None
+    ):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads is not None:
+            options.inter_op_num_threads = inter_op_num_threads
+        options.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]
+        )
+
+        self.path = path
+        self.session = ort.InferenceSession(
+            path, sess_options=options, providers=providers or ['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        x_np = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        out = self.session.run(None, {self.input_name: x_np})
+        out = tuple(torch.from_numpy(o).to(x.device) for o in out)
+        return out if len(out) > 1 else out[0]
+
+
+def load_onnx(name, build_fn, example_input, weights_paths, output_names, dynamic_spatial=False,
+              cache_dir=None, rebuild=False, atol=1e-4, sources=(), **session_options):
+    """Load an ONNX Runtime net, exporting it first if the export is missing or stale.
+
+    Exports are keyed by a hash of the weight files and model code like frozen TorchScript
+    artifacts (see
+    models.utils.freeze). A fresh export is checked for parity against the PyTorch model on
+    `example_input` before it is used.
+
+    Arguments:
+        name {str} -- Model name used in the filename.
+        build_fn {callable} -- Zero-argument function returning the eager model with its weights
+            loaded. Only called when the model has to be (re)exported.
+        example_input {torch.Tensor} -- Representative input used for export and the parity check.
+        weights_paths {list} -- Weight files the model is built from.
+        output_names {list} -- Names of the model outputs, in forward() order.
+
+    Keyword Arguments:
+        dynamic_spatial {bool} -- Make height/width dynamic. (default: {False})
+        cache_dir {str} -- Export directory. (default: {<frozen home>/onnx})
+        rebuild {bool} -- Force a new export. (default: {False})
+        atol {float} -- Parity tolerance for a fresh export. (default: {1e-4})
+        sources {list} -- Classes or modules defining the model, see weights_hash.
+            (default: {()})
+        **session_options -- Passed to OnnxNet (threads, graph optimization level, providers).
+
+    Returns:
+        OnnxNet -- The loaded session.
+    """
+    path = onnx_path(name, weights_paths, cache_dir, sources)
+    if rebuild or not os.path.exists(path):
+        model = build_fn().eval()
+        cache_dir = os.path.dirname(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        export_onnx(model, example_input, tmp_path, output_names, dynamic_spatial=dynamic_spatial)
+
+        check_parity(model, OnnxNet(tmp_path), example_input, atol=atol)
+        os.replace(tmp_path, path)
+        remove_stale(cache_dir, name, path, '.onnx')
+
+    return OnnxNet(path, **session_options)
+
+
+def check_parity(torch_model, onnx_model, x, atol=1e-4):
+    """Raise if ONNX Runtime and PyTorch outputs differ by more than `atol`.
+
+    Returns:
+        float -- Largest absolute difference over all outputs.
+    """
+    with torch.no_grad():
+        expected = torch_model(x)
+    actual = onnx_model(x)
+    if isinstance(expected, torch.Tensor):
+        expected, actual = (expected,), (actual,)
+    max_diff = max((e.float() - a.float()).abs().max().item() for e, a in zip(expected, actual))
+    if max_diff > atol:
+        raise RuntimeError(
+            'ONNX export of {} differs from PyTorch by {:.3g} (atol={})'.format(
+                type(torch_model).__name__, max_diff, atol
+            )
+        )
+    return max_diff
@@ -0,0 +1,41 @@
+"""Reduced-precision (bfloat16/float16) execution.
+
+Only the networks run in the reduced dtype: their weights are cast and their inputs are cast
+right before the forward pass. Everything numerically sensitive around them (image
+resampling, box regression, NMS, embedding normalisation and similarities) stays in float32.
+"""
+
+import torch
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def precision_dtype(precision):
+    """torch dtype for a precision name ('fp32', 'bf16' or 'fp16')."""
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {!r}, expected one of {}'.format(
+            precision, ', '.join(PRECISIONS)
+        ))
+    return PRECISIONS[precision]
+
+
+def frozen_name(name, precision):
+    """Frozen artifact name for a net compiled at `precision`.
+
+    fp32 keeps the plain name, so existing artifacts stay valid, and reduced-precision
+    artifacts get their own name so that load_frozen does not evict one for the other.
+    """
+    return name if precision == 'fp32' else '{}_{}'.format(name, precision)
+
+
+def mark_input_dtype(module, precision):
+    """Record the input dtype on a frozen module, which has no parameters to read it from.
+
+    get_model_dtype() and the embedders read it back to cast inputs.
+    """
+    module.input_dtype = precision_dtype(precision)
+    return module
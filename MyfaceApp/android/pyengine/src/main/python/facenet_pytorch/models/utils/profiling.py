@@ -0,0 +1,143 @@
+"""Opt-in per-stage profiling.
+
+detect_face, MTCNN and FaceProcessor wrap their stages in named spans (`span('pnet/net')`) and
+report how many candidate boxes survive each stage (`count('rnet/boxes', n)`). Nothing is
+recorded unless a Profile is active in the current context, so the instrumentation costs a
+context variable lookup per span when profiling is off.
+
+Example:
+>>> from facenet_pytorch import profiling
+>>> with profiling.profile() as prof:
+...     boxes, probs = mtcnn.detect(img)
+>>> print(prof.report())
+>>> prof.totals()['pnet/net'], prof.counters['onet/boxes']
+
+Profiles are tracked with contextvars, so concurrent requests (threads or asyncio tasks) each
+see only their own spans. Work handed to other threads (e.g. a BackgroundWriter) is not
+recorded. CUDA kernels run asynchronously; pass synchronize=True to time them accurately.
+"""
+
+import contextlib
+import time
+from collections import namedtuple
+from contextvars import ContextVar
+
+Span = namedtuple('Span', ['name', 'start_ms', 'ms', 'depth'])
+
+_active = ContextVar('facenet_profile', default=None)
+_disabled = contextlib.nullcontext()
+
+
+class Profile(object):
+    """Spans and counters collected while the profile is active.
+
+    Keyword Arguments:
+        on_span {callable} -- Called as on_span(span) as each span finishes, e.g. to forward
+            timings to a metrics system. (default: {None})
+        synchronize {bool} -- Wait for pending CUDA work at span boundaries. (default: {False})
+    """
+
+    def __init__(self, on_span=None, synchronize=False):
+        self.on_span = on_span
+        self.synchronize = synchronize
+        self.spans = []
+        self.counters = {}
+        self._depth = 0
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        self._sync()
+        start = time.perf_counter()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            self._sync()
+            end = time.perf_counter()
+            span = Span(name, (start - self._origin) * 1000, (end - start) * 1000, self._depth)
+            self.spans.append(span)
+            if self.on_span is not None:
+                self.on_span(span)
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def totals(self):
+        """Total milliseconds per span name, in order of first completion."""
+        totals = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0.0) + span.ms
+        return totals
+
+    def calls(self):
+        """Number of spans per name."""
+        calls = {}
+        for span in self.spans:
+            calls[span.name] = calls.get(span.name, 0) + 1
+        return calls
+
+    def as_dict(self):
+        """JSON-serialisable summary: per-name total ms and calls, and the counters."""
+        calls = self.calls()
+        return {
+            'spans': {
+                name: {'ms': round(ms, 3), 'calls': calls[name]}
+                for name, ms in self.totals().items()
+            },
+            'counters': dict(self.counters),
+        }
+
+    def report(self):
+        """Table of span totals, indented by nesting depth, followed by the counters."""
+        depths, starts, calls, totals = {}, {}, self.calls(), self.totals()
+        for span in self.spans:
+            depths.setdefault(span.name, span.depth)
+            starts[span.name] = min(starts.get(span.name, span.start_ms), span.start_ms)
+        # parents finish after their children, so list names by first start instead
+        order = sorted(totals, key=starts.get)
+        lines = ['{:<32} {:>10} {:>6}'.format('span', 'ms', 'calls')]
+        for name in order:
+            label = '  ' * depths[name] + name
+            lines.append('{:<32} {:>10.2f} {:>6}'.format(label, totals[name], calls[name]))
+        for name, value in self.counters.items():
+            lines.append('{:<32} {:>10}'.format(name, value))
+        return '\n'.join(lines)
+
+    def _sync(self):
+        if self.synchronize:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+
+
+@contextlib.contextmanager
+def profile(on_span=None, synchronize=False):
+    """Collect spans and counters from everything run in this context, see Profile."""
+    prof = Profile(on_span, synchronize)
+    token = _active.set(prof)
+    try:
+        yield prof
+    finally:
+        _active.reset(token)
+
+
+def active():
+    """The Profile collecting in this context, or None."""
+    return _active.get()
+
+
+def span(name):
+    """Context manager timing `name` in the active profile; a shared no-op when there is none."""
+    prof = _active.get()
+    if prof is None:
+        return _disabled
+    return prof.span(name)
+
+
+def count(name, value):
+    """Add `value` to the counter `name` of the active profile, if any."""
+    prof = _active.get()
+    if prof is not None:
+        prof.count(name, value)
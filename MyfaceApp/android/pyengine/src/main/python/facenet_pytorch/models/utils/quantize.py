@@ -0,0 +1,50 @@
+import copy
+
+import torch
+
+from .freeze import freeze_module
+
+
+def quantize_static(model, calibration_batches, backend='x86'):
+    """Post-training static int8 quantization with per-channel weights.
+
+    Uses FX graph mode quantization, so the model does not need QuantStub/DeQuantStub
+    wrappers. Activation ranges are calibrated by running `calibration_batches` through the
+    observed model.
+
+    Arguments:
+        model {torch.nn.Module} -- fp32 model with weights loaded (CPU).
+        calibration_batches {iterable} -- Input tensors representative of production traffic.
+
+    Keyword Arguments:
+        backend {str} -- Quantized engine to target, 'x86' (fbgemm) for servers or 'qnnpack'
+            for ARM devices. (default: {'x86'})
+
+    Returns:
+        torch.nn.Module -- The converted int8 model.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = 'qnnpack' if backend == 'qnnpack' else 'x86'
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+
+    batches = iter(calibration_batches)
+    first = next(batches)
+    prepared = prepare_fx(copy.deepcopy(model).eval(), qconfig_mapping, (first,))
+    with torch.no_grad():
+        prepared(first)
+        for batch in batches:
+            prepared(batch)
+
+    return convert_fx(prepared)
+
+
+def save_quantized(model, example_input, path):
+    """Serialize a quantized model as a frozen TorchScript file loadable with torch.jit.load."""
+    torch.jit.save(freeze_module(model, example_input), path)
+
+
+def load_quantized(path):
+    """Load a quantized TorchScript model. Quantized kernels only run on the CPU."""
+    return torch.jit.load(path, map_location='cpu')
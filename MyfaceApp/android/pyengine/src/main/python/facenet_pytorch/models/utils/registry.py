@@ -0,0 +1,65 @@
+"""Process-wide model registry.
+
+Every network (MTCNN P/R/O-nets, embedders) is created once per process and shared by all
+callers that ask for the same (architecture, weights, device, precision, backend, options)
+key. Creation is lazy and thread-safe: concurrent requests for the same key block until the
+first one has loaded the model, while different keys load in parallel.
+"""
+
+import threading
+
+_models = {}
+_key_locks = {}
+_registry_lock = threading.Lock()
+
+
+def model_key(arch, weights=None, device='cpu', precision='fp32', backend='torch', options=None):
+    """Hashable registry key. `options` (e.g. ONNX session options) must have hashable values."""
+    options = tuple(sorted((options or {}).items()))
+    return (arch, weights, str(device), precision, backend, options)
+
+
+def get_model(arch, factory, weights=None, device='cpu', precision='fp32', backend='torch',
+              options=None):
+    """Return the shared model for a key, creating it with `factory()` on first use.
+
+    Arguments:
+        arch {str} -- Architecture name, e.g. 'pnet' or 'mobilefacenet'.
+        factory {callable} -- Zero-argument function that loads the model. Only called on a
+            cache miss; callers asking for the same key must pass equivalent factories.
+
+    Keyword Arguments:
+        weights {str} -- Path (or name) of the weights the model is built from. (default: {None})
+        device {str} -- Device the model lives on. (default: {'cpu'})
+        precision {str} -- Numeric precision, e.g. 'fp32' or 'int8'. (default: {'fp32'})
+        backend {str} -- Execution backend, e.g. 'torch', 'frozen' or 'onnx'. (default: {'torch'})
+        options {dict} -- Extra backend options that change the loaded object. (default: {None})
+
+    Returns:
+        object -- The cached model.
+    """
+    key = model_key(arch, weights, device, precision, backend, options)
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        model = _models.get(key)
+        if model is None:
+            model = factory()
+            _models[key] = model
+    return model
+
+
+def loaded_models():
+    """Keys of all models loaded so far."""
+    return list(_models)
+
+
+def clear():
+    """Drop every cached model (mainly for tests and benchmarks)."""
+    with _registry_lock:
+        _models.clear()
+        _key_locks.clear()
@@ -0,0 +1,98 @@
+"""Background image writer.
+
+Saving face crops (MTCNN's `save_path`) is disk I/O that callers rarely need to wait for. A
+BackgroundWriter hands every write to a small thread pool. At most `max_pending` writes are
+queued or running; further saves block until one finishes, so a slow disk slows the producer
+down instead of letting crops pile up in memory.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .detect_face import save_img
+
+
+class BackgroundWriter(object):
+    """Bounded thread pool for writing images to disk.
+
+    Errors raised by a write are kept and re-raised by the next flush() (or close()), so they
+    are not lost with the thread.
+
+    Keyword Arguments:
+        max_workers {int} -- Writer threads. (default: {2})
+        max_pending {int} -- Writes queued or running before save() blocks. (default: {64})
+
+    Example:
+    >>> writer = BackgroundWriter()
+    >>> mtcnn = MTCNN(writer=writer)
+    >>> faces = mtcnn(img, save_path='faces/face.png')
+    >>> writer.flush()  # wait until the crops are on disk
+    """
+
+    def __init__(self, max_workers=2, max_pending=64):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._errors = []
+
+    @property
+    def pending(self):
+        """Number of writes queued or running."""
+        with self._lock:
+            return len(self._pending)
+
+    def save(self, img, path):
+        """Write a PIL image or RGB numpy array to `path`, creating its directory."""
+        self.submit(_save, img, path)
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on a writer thread, blocking while max_pending writes are outstanding."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def flush(self):
+        """Wait for every write submitted so far, then raise the first error since the last flush."""
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.exception()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        """Flush and stop the writer threads."""
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _save(img, path):
+    os.makedirs(os.path.dirname(path) + "/", exist_ok=True)
+    save_img(img, path)
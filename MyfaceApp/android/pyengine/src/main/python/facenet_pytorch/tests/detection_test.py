@@ -0,0 +1,593 @@
+"""
+Checks of the detection, embedding-model loading and face extraction paths that need no network
+access (unlike actions_test.py, which downloads the InceptionResnetV1 weights). Run from the
+package root with `python -c "import tests.detection_test"`.
+"""
+
+from PIL import Image
+import torch
+from torchvision.ops import box_iou
+import numpy as np
+import os
+import glob
+
+from models.mtcnn import MTCNN
+
+
+def best_iou(boxes, others):
+    """IoU of each of the N x 4 `boxes` with its best match among the M x 4 `others`."""
+    boxes = torch.as_tensor(np.asarray(boxes, dtype=np.float64)).reshape(-1, 4)
+    others = torch.as_tensor(np.asarray(others, dtype=np.float64)).reshape(-1, 4)
+    return box_iou(boxes, others).max(1).values.numpy()
+
+
+#### FROZEN MODELS TEST ####
+
+img = Image.open('data/multiface.jpg')
+
+mtcnn = MTCNN(keep_all=True)
+boxes_ref, _ = mtcnn.detect(img)
+
+mtcnn = MTCNN(keep_all=True, frozen=True)
+boxes_test, _ = mtcnn.detect(img)
+
+total_error = np.sum(np.abs(boxes_ref - boxes_test))
+print('\nFrozen total box error: {}'.format(total_error))
+
+assert total_error < 1e-2
+
+# artifacts are keyed by the model code too, and cleanup keeps the current artifact
+import tempfile
+from models.mtcnn import PNet, RNet, _state_dict_path
+from models.utils.freeze import frozen_path, remove_stale
+
+cache_dir = tempfile.mkdtemp()
+current = frozen_path('pnet', [_state_dict_path('pnet')], cache_dir, sources=[PNet])
+stale = frozen_path('pnet', [_state_dict_path('pnet')], cache_dir, sources=[RNet])
+assert current != stale
+for path in (current, stale):
+    open(path, 'wb').close()
+remove_stale(cache_dir, 'pnet', current, '.pt')
+assert os.path.exists(current) and not os.path.exists(stale)
+
+
+#### MODEL REGISTRY TEST ####
+
+from threading import Thread
+from models.utils import registry
+
+registry.clear()
+detectors = []
+threads = [Thread(target=lambda: detectors.append(MTCNN(image_size=112))) for _ in range(4)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+assert len(set(id(d.pnet) for d in detectors)) == 1
+assert len(registry.loaded_models()) == 3
+assert MTCNN(shared=False).pnet is not detectors[0].pnet
+
+# casting one instance gives it private nets; the others and the registry stay fp32
+cast = MTCNN(image_size=112).double()
+assert cast.pnet is not detectors[0].pnet
+assert next(cast.pnet.parameters()).dtype == torch.float64
+assert next(detectors[0].pnet.parameters()).dtype == torch.float32
+assert next(MTCNN(image_size=112).onet.parameters()).dtype == torch.float32
+
+
+#### ONNX RUNTIME TEST ####
+
+from models.mtcnn import PNet, RNet, ONet, load_onnx_nets
+from models.utils.onnx_backend import check_parity
+
+onnx_nets = load_onnx_nets(rebuild=True, intra_op_num_threads=1)
+for net, onnx_net, x in zip(
+    [PNet(), RNet(), ONet()], onnx_nets,
+    [torch.rand(2, 3, 97, 131), torch.rand(32, 3, 24, 24), torch.rand(32, 3, 48, 48)]
+):
+    print('{} ONNX max abs diff: {}'.format(type(net).__name__, check_parity(net, onnx_net, x)))
+
+img = Image.open('data/multiface.jpg')
+
+mtcnn = MTCNN(keep_all=True, backend='onnx', onnx_options={'graph_optimization_level': 'basic'})
+boxes_test, _ = mtcnn.detect(img)
+
+box_diff = boxes_ref[np.argsort(boxes_ref[:,1])] - boxes_test[np.argsort(boxes_test[:,1])]
+total_error = np.sum(np.abs(box_diff))
+print('ONNX total box error: {}'.format(total_error))
+
+assert total_error < 1e-2
+
+
+#### BATCHED CROP TEST ####
+
+from models.utils import detect_face as df
+
+def loop_crop_boxes(integral, boxes, image_inds, size, dtype=torch.float32, image_sizes=None):
+    # Reference: crop and area-resize each box on its own
+    imgs = integral.diff(dim=1).diff(dim=2).permute(0, 3, 1, 2)
+    y, ey, x, ex = df.pad(boxes, imgs.shape[3], imgs.shape[2])
+    keep = (ey > y - 1) & (ex > x - 1)
+    crops = [
+        df.imresample(imgs[image_inds[k], :, (y[k] - 1):ey[k], (x[k] - 1):ex[k]].unsqueeze(0), (size, size))
+        for k in range(len(boxes)) if keep[k]
+    ]
+    crops = torch.cat(crops) if crops else imgs.new_zeros((0, imgs.shape[1], size, size))
+    return crops.to(dtype), boxes[keep], image_inds[keep]
+
+imgs = torch.randint(0, 256, (2, 3, 97, 131)).float()
+integral = df.integral_image(imgs)
+xy = torch.rand(200, 2) * torch.tensor([150., 115.]) - 10
+boxes = torch.cat([xy, xy + torch.rand(200, 1) * 90 + 1, torch.rand(200, 1)], dim=1)
+image_inds = torch.randint(0, 2, (200,))
+for size in [24, 48]:
+    crops, kept, _ = df.crop_boxes(integral, boxes, image_inds, size)
+    crops_ref, kept_ref, _ = loop_crop_boxes(integral, boxes, image_inds, size)
+    assert torch.equal(kept, kept_ref)
+    assert (crops - crops_ref).abs().max() < 1e-3
+
+img = Image.open('data/multiface.jpg')
+mtcnn = MTCNN(keep_all=True)
+boxes_test, probs_test, points_test = mtcnn.detect(img, landmarks=True)
+batched_crop_boxes, df.crop_boxes = df.crop_boxes, loop_crop_boxes
+boxes_ref, probs_ref, points_ref = mtcnn.detect(img, landmarks=True)
+df.crop_boxes = batched_crop_boxes
+
+total_error = np.sum(np.abs(boxes_ref - boxes_test)) + np.sum(np.abs(points_ref - points_test))
+print('\nBatched crop total box + landmark error: {}'.format(total_error))
+
+assert total_error < 1e-2
+
+
+#### TORCH NMS TEST ####
+
+xy = torch.rand(500, 2) * 300
+boxes = torch.cat([xy, xy + torch.rand(500, 2) * 80 + 5], dim=1)
+scores = torch.rand(500)
+image_inds = torch.randint(0, 3, (500,))
+for method in ['Min', 'Union']:
+    for block_size in [16, 256]:
+        pick_ref = df.batched_nms_numpy(boxes, scores, image_inds, 0.7, method)
+        pick = df.batched_nms_torch(boxes, scores, image_inds, 0.7, method, block_size=block_size)
+        assert torch.equal(pick, pick_ref)
+
+# candidates are capped per image
+pick = df.batched_nms_torch(
+    boxes, scores, torch.zeros(500, dtype=torch.long), 0.7, 'Min', max_candidates=10
+)
+assert set(pick.tolist()) <= set(scores.argsort(descending=True)[:10].tolist())
+
+
+#### DETECTION PRESETS TEST ####
+
+img = Image.open('data/test_images/kate_siegel/1.jpg')
+
+stats_ref, stats_test = {}, {}
+boxes_ref, _ = MTCNN().detect(img, stats=stats_ref)
+boxes_test, _ = MTCNN(preset='selfie').detect(img, stats=stats_test)
+print('\nPyramid: {} -> {} scales, {} -> {} PNet pixels'.format(
+    stats_ref['scales'], stats_test['scales'], stats_ref['pnet_pixels'], stats_test['pnet_pixels']
+))
+
+assert stats_test['scales'] < stats_ref['scales']
+assert stats_test['pnet_pixels'] < stats_ref['pnet_pixels']
+assert np.sum(np.abs(boxes_ref[0] - boxes_test[0])) < 10
+
+stats_test = {}
+MTCNN(max_face_size=100).detect(img, stats=stats_test)
+assert stats_test['face_sizes'][1] <= 100 / 0.709
+
+assert MTCNN(min_face_size=60).detect(Image.new('RGB', (40, 40)))[0] is None
+
+
+#### SINGLE-FACE EARLY EXIT TEST ####
+
+for path in glob.glob('data/test_images/*/*.jpg'):
+    img = Image.open(path)
+    stats_ref, stats_test = {}, {}
+    boxes_ref, _ = MTCNN().detect(img, stats=stats_ref)
+    boxes_test, _ = MTCNN(single_face=True).detect(img, stats=stats_test)
+
+    iou = best_iou(boxes_test[:1], boxes_ref[:1])[0]
+    print('{}: {} -> {} scales, largest face IoU {:.3f}'.format(
+        path, stats_ref['scales'], stats_test['scales'], iou
+    ))
+
+    assert stats_test['early_exit'] and stats_test['scales'] < stats_ref['scales']
+    assert iou > 0.9
+
+    # face sizes come [smallest, largest] from both, the early exit skipping the smallest
+    (ref_low, ref_high), (test_low, test_high) = stats_ref['face_sizes'], stats_test['face_sizes']
+    assert ref_low < test_low <= test_high and abs(test_high - ref_high) < 1e-6 * ref_high
+
+# images of a batch finish independently
+mtcnn = MTCNN(single_face=True)
+img = np.array(Image.open('data/test_images/kate_siegel/1.jpg'))
+batch_boxes, _ = mtcnn.detect(np.stack([img, np.zeros_like(img)]))
+assert batch_boxes[0] is not None and batch_boxes[1] is None
+
+
+#### PACKED PYRAMID TEST ####
+
+from models.utils.detect_face import pack_pyramid, pyramid_scales
+
+# levels are disjoint, gutter-separated, on even offsets and inside the canvas
+scales = pyramid_scales(720, 1280, 20, 0.709)
+sizes = [(int(720 * s + 1), int(1280 * s + 1)) for s in scales]
+offsets, (canvas_h, canvas_w) = pack_pyramid(sizes)
+for i, ((y, x), (h, w)) in enumerate(zip(offsets, sizes)):
+    assert y % 2 == 0 and x % 2 == 0
+    assert y + h <= canvas_h and x + w <= canvas_w
+    for (y2, x2), (h2, w2) in zip(offsets[i + 1:], sizes[i + 1:]):
+        assert y + h + 2 <= y2 or y2 + h2 + 2 <= y or x + w + 2 <= x2 or x2 + w2 + 2 <= x
+print('packed {} levels into {}x{} ({:.0%} filled)'.format(
+    len(sizes), canvas_w, canvas_h, sum(h * w for h, w in sizes) / (canvas_h * canvas_w)
+))
+
+# one PNet pass over the packed canvas finds the same faces as one pass per level
+mtcnn_ref = MTCNN(keep_all=True)
+mtcnn_test = MTCNN(keep_all=True, packed_pyramid=True)
+for path in glob.glob('data/test_images/*/*.jpg') + ['data/multiface.jpg']:
+    img = Image.open(path)
+    boxes_ref, probs_ref = mtcnn_ref.detect(img)
+    boxes_test, probs_test = mtcnn_test.detect(img)
+    assert boxes_ref.shape == boxes_test.shape
+    assert np.abs(boxes_ref - boxes_test).max() < 1e-2
+    assert np.abs(probs_ref - probs_test).max() < 1e-4
+
+
+#### CV2 PYRAMID TEST ####
+
+from models.utils.detect_face import pyramid_levels
+
+# uint8 levels of the expected sizes, close to float area resampling of the full image
+img = torch.as_tensor(np.array(Image.open('data/multiface.jpg'))).permute(2, 0, 1)[None].float()
+sizes = [(int(img.shape[2] * s + 1), int(img.shape[3] * s + 1)) for s in (0.6, 0.3, 0.15)]
+for ref, level in zip(pyramid_levels(img, sizes), pyramid_levels(img, sizes, 'cv2')):
+    assert level.dtype == torch.uint8 and level.shape == ref.shape
+    assert (level.float() - ref).abs().mean() < 2
+
+# the uint8 batch the float one was made from gives the same levels without converting back
+frames = img.permute(0, 2, 3, 1).byte()
+for level, direct in zip(pyramid_levels(img, sizes, 'cv2'), pyramid_levels(img, sizes, 'cv2', frames)):
+    assert torch.equal(level, direct)
+
+# every confident face is still found, in about the same place
+mtcnn_ref = MTCNN(keep_all=True)
+mtcnn_test = MTCNN(keep_all=True, pyramid='cv2')
+for path in glob.glob('data/test_images/*/*.jpg') + ['data/multiface.jpg']:
+    img = Image.open(path)
+    boxes_ref, probs_ref = mtcnn_ref.detect(img)
+    boxes_test, probs_test = mtcnn_test.detect(img)
+    confident = boxes_ref[probs_ref > 0.99]
+    for box, iou in zip(confident, best_iou(confident, boxes_test)):
+        assert iou > 0.8, '{}: face {} moved (IoU {:.2f})'.format(path, box, iou)
+
+try:
+    MTCNN(pyramid='pil')
+    assert False, 'unknown pyramid backend accepted'
+except ValueError:
+    pass
+
+
+#### FACE TRACKER TEST ####
+
+from models.tracker import FaceTracker
+
+# a face panning across a 640x720 camera frame
+img = np.array(Image.open('data/test_images/kate_siegel/1.jpg').resize((800, 1146)))
+frames = [img[20 + 3 * i:740 + 3 * i, 40 + 2 * i:680 + 2 * i] for i in range(12)]
+
+mtcnn = MTCNN()
+tracker = FaceTracker(mtcnn, redetect_every=5)
+tracked = []
+for frame in frames:
+    stats = {}
+    boxes, probs = tracker.detect(frame, stats=stats)
+    boxes_ref, _ = mtcnn.detect(frame, stats={})
+    tracked.append(stats['tracked'])
+
+    assert best_iou(boxes[:1], boxes_ref[:1])[0] > 0.85
+    assert probs[0] > 0.9
+    if stats['tracked']:
+        assert stats['pnet_pixels'] < 0.05 * 640 * 720
+print('tracked frames:', tracked)
+assert tracked == ([False] + [True] * 4) * 2 + [False, True]
+
+# a lost face falls back to full detection
+boxes, probs = tracker.detect(np.zeros_like(frames[0]))
+assert boxes is None and not tracker.frames_since_detection
+boxes, _ = tracker.detect(frames[0], stats=stats)
+assert boxes is not None and not stats['tracked']
+
+
+#### RAGGED BATCH TEST ####
+
+from models.utils.detect_face import bucket_images, crop_boxes, integral_image
+
+# similar shapes share a batch, portrait and landscape never do
+sizes = [(800, 640), (900, 720), (780, 600), (336, 640), (378, 720), (1600, 1280)]
+buckets = bucket_images(sizes)
+print('buckets:', buckets)
+assert sorted(i for bucket in buckets for i in bucket) == list(range(len(sizes)))
+assert not any({3, 0} <= set(bucket) for bucket in buckets)
+assert [5] in buckets
+
+# crops clipped to each image's own size ignore the padding
+img = torch.as_tensor(np.array(Image.open('data/multiface.jpg'))).permute(2, 0, 1)[None].float()
+padded = torch.nn.functional.pad(img, (0, 57, 0, 31))
+boxes = torch.tensor([[600., 400., 1300., 700., 1.], [-20., -10., 80., 90., 1.], [1150., 580., 1250., 680., 1.]])
+inds = torch.zeros(3, dtype=torch.int64)
+crops_ref, _, _ = crop_boxes(integral_image(img), boxes, inds, 24)
+crops, _, _ = crop_boxes(integral_image(padded), boxes, inds, 24, image_sizes=torch.tensor([img.shape[2:]]))
+assert torch.allclose(crops, crops_ref)
+
+# mixed sizes in one call: every image's faces, in input order
+mtcnn = MTCNN(keep_all=True)
+imgs = [Image.open(path) for path in sorted(glob.glob('data/test_images/*/*.jpg'))]
+imgs = [img.resize((w, img.size[1] * w // img.size[0])) for img, w in zip(imgs, [640, 720, 600, 700])]
+imgs += [Image.open('data/multiface.jpg'), Image.new('RGB', (320, 240))]
+stats = {}
+batch_boxes, batch_probs = mtcnn.detect(imgs, stats=stats)
+assert stats['buckets'] < len(imgs)
+for img, boxes, probs in zip(imgs, batch_boxes, batch_probs):
+    boxes_ref, _ = mtcnn.detect(img)
+    if boxes_ref is None:
+        assert boxes is None
+        continue
+    assert len(boxes) == len(boxes_ref)
+    assert best_iou(boxes_ref, boxes).min() > 0.8
+
+batch_boxes, _ = MTCNN(single_face=True).detect(imgs)
+assert [boxes is None for boxes in batch_boxes] == [False] * 5 + [True]
+
+
+#### TILED DETECTION TEST ####
+
+from models.utils.detect_face import tile_spans
+
+# tiles cover the image, overlap by at least the overlap and stay within the tile size
+for length, tile, overlap in [(1000, 400, 96), (4001, 1186, 148), (300, 400, 96)]:
+    spans = tile_spans(length, tile, overlap)
+    assert spans[0][0] == 0 and spans[-1][1] == length
+    assert all(stop - start <= tile for start, stop in spans)
+    assert all(a[1] - b[0] >= overlap for a, b in zip(spans, spans[1:]))
+
+# a budget far below the whole-image estimate finds the same faces through tiles
+img = Image.open('data/multiface.jpg')
+boxes_ref, _ = MTCNN(keep_all=True).detect(img)
+stats = {}
+boxes, probs = MTCNN(keep_all=True, max_memory_mb=16).detect(img, stats=stats)
+print('tiled detection:', stats)
+assert stats['tiles'] > 1
+assert len(boxes) == len(boxes_ref)
+assert best_iou(boxes_ref, boxes).min() > 0.8
+
+# within budget nothing changes
+boxes, _ = MTCNN(keep_all=True, max_memory_mb=1024).detect(img, stats=stats)
+assert stats['tiles'] == 1 and np.allclose(boxes.astype(float), boxes_ref.astype(float))
+
+
+#### PLAN CACHE TEST ####
+
+from models.utils.detect_face import PlanCache, detection_plan
+
+# plans are reused per resolution and the least recently used one is evicted
+cache = PlanCache(maxsize=2)
+plans = [cache.get(h, 640, 20, 0.709) for h in (480, 360, 480, 720)]
+assert plans[0] is plans[2] and plans[1] is not plans[3]
+assert tuple(cache.info()) == (1, 3, 1, 2, 2)
+assert cache.get(360, 640, 20, 0.709) is not plans[1]
+
+# cached plans give the same faces as fresh ones, also through the buffers of a second call
+img = Image.open('data/multiface.jpg')
+boxes_ref, _ = MTCNN(keep_all=True, plan_cache_size=0).detect(img)
+mtcnn = MTCNN(keep_all=True)
+for _ in range(2):
+    boxes, _ = mtcnn.detect(img)
+    assert np.allclose(boxes.astype(float), boxes_ref.astype(float))
+assert mtcnn.plan_cache_info().hits == 1 and mtcnn.plan_cache_info().misses == 1
+mtcnn = MTCNN(keep_all=True, packed_pyramid=True)
+for _ in range(2):
+    boxes, _ = mtcnn.detect([img, img])
+    assert np.allclose(boxes[1].astype(float), boxes_ref.astype(float))
+
+# buffers beyond a plan's budget are not kept
+plan = PlanCache(max_buffer_mb=1).get(1000, 1000, 20, 0.709)
+plan.buffer('small', (1000,), torch.float32, torch.device('cpu'))
+plan.buffer('large', (1000, 1000), torch.float32, torch.device('cpu'))
+assert list(plan.buffers) == ['small']
+
+# a plan whose buffers are in use is not shared
+batch = torch.zeros((1, 100, 100, 3))
+with detection_plan(cache, batch, 20, 0.709) as plan:
+    with detection_plan(cache, batch, 20, 0.709) as other:
+        assert other is not plan and other.scales == plan.scales
+
+
+#### BATCH DETECTIONS TEST ####
+
+from models.utils.detect_face import BatchDetections
+
+# one flat result for the whole batch, the same faces detect() returns per image
+img = Image.open('data/multiface.jpg')
+imgs = [img, Image.new('RGB', img.size), img.transpose(Image.FLIP_LEFT_RIGHT)]
+mtcnn = MTCNN(keep_all=True)
+detections = mtcnn.detect_batch(imgs)
+batch_boxes, batch_probs, batch_points = mtcnn.detect(imgs, landmarks=True)
+assert len(detections) == 3 and detections.counts[1] == 0 and batch_boxes[1] is None
+assert detections.offsets[-1] == len(detections.boxes) == len(detections.probs)
+for i in (0, 2):
+    boxes, probs, points = detections[i]
+    assert np.array_equal(boxes, batch_boxes[i]) and np.array_equal(points, batch_points[i])
+    assert (np.diff((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])) <= 0).all()
+
+# the per-image adapter round-trips
+batch_boxes, batch_points = detections.split()
+again = BatchDetections.from_split(batch_boxes, batch_points)
+assert np.array_equal(again.offsets, detections.offsets) and np.array_equal(again.boxes, detections.boxes)
+
+
+#### VECTORIZED SELECTION TEST ####
+
+# every method picks the face the per-image argsort picks, in one pass over the batch
+rng = np.random.default_rng(0)
+counts = [3, 0, 1, 7, 2]
+all_boxes, all_probs, all_points = [], [], []
+for n in counts:
+    xy = rng.uniform(0, 400, (n, 2))
+    all_boxes.append(np.concatenate([xy, xy + rng.uniform(20, 200, (n, 2))], 1).astype(np.float32) if n else None)
+    all_probs.append(rng.uniform(0.8, 1.0, n).astype(np.float32) if n else [None])
+    all_points.append(rng.uniform(0, 600, (n, 5, 2)).astype(np.float32) if n else None)
+all_boxes, all_probs, all_points = (np.array(x, dtype=object) for x in (all_boxes, all_probs, all_points))
+imgs = [Image.new('RGB', (640, 480))] * len(counts)
+
+mtcnn = MTCNN()
+for method in ['probability', 'largest', 'largest_over_threshold', 'center_weighted_size']:
+    boxes, probs, points = mtcnn.select_boxes(all_boxes, all_probs, all_points, imgs, method=method)
+    for i in range(len(counts)):
+        if all_boxes[i] is None or (method == 'largest_over_threshold' and all_probs[i].max() <= 0.9):
+            assert boxes[i] is None and points[i] is None and probs[i] == [None]
+            continue
+        b = all_boxes[i]
+        area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        score = {
+            'probability': all_probs[i],
+            'largest': area,
+            'largest_over_threshold': np.where(all_probs[i] > 0.9, area, -np.inf),
+            'center_weighted_size': area - (((b[:, :2] + b[:, 2:]) / 2 - [320, 240]) ** 2).sum(1) * 2,
+        }[method]
+        best = np.argsort(score)[::-1][0]
+        assert np.array_equal(boxes[i], b[[best]]) and probs[i][0] == all_probs[i][best]
+        assert np.array_equal(points[i], all_points[i][[best]])
+
+    box, prob, point = mtcnn.select_boxes(all_boxes[3], all_probs[3], all_points[3], imgs[3], method=method)
+    assert np.array_equal(box, boxes[3]) and prob == probs[3][0]
+
+# ties go to the later face, as with the reversed argsort
+box, _, _ = mtcnn.select_boxes(
+    np.array([[0, 0, 10, 10], [20, 0, 30, 10]], dtype=np.float32), np.array([0.95, 0.95], dtype=np.float32),
+    np.zeros((2, 5, 2), dtype=np.float32), imgs[0], method='probability'
+)
+assert box[0, 0] == 20
+
+
+#### BATCHED EXTRACT TEST ####
+
+import shutil
+import tempfile
+import threading
+from models.utils.detect_face import extract_faces, extract_face
+from models.utils.writer import BackgroundWriter
+
+# one stacked tensor with the faces extract_face gives box by box, for every image type
+img = Image.open('data/multiface.jpg')
+boxes, _ = MTCNN(keep_all=True).detect(img)
+for im in [img, np.array(img), torch.as_tensor(np.array(img))]:
+    for margin in [0, 14]:
+        faces = extract_faces(im, boxes, 112, margin)
+        faces_ref = torch.stack([extract_face(im, box, 112, margin) for box in boxes])
+        assert torch.equal(faces, faces_ref)
+
+# crops saved in the background land where forward() used to write them
+tmp_dir = tempfile.mkdtemp()
+with BackgroundWriter(max_workers=2, max_pending=2) as writer:
+    faces = MTCNN(keep_all=True, writer=writer)(img, save_path=os.path.join(tmp_dir, 'face.png'))
+assert len(glob.glob(os.path.join(tmp_dir, '*.png'))) == len(faces) == len(boxes)
+shutil.rmtree(tmp_dir)
+
+# save() blocks while max_pending writes are outstanding, and write errors reach flush()
+release = threading.Event()
+writer = BackgroundWriter(max_workers=1, max_pending=2)
+writer.submit(release.wait)
+writer.submit(release.wait)
+blocked = threading.Thread(target=writer.submit, args=(release.wait,))
+blocked.start()
+blocked.join(0.2)
+assert blocked.is_alive() and writer.pending == 2
+release.set()
+blocked.join()
+writer.submit(os.remove, os.path.join(tmp_dir, 'missing.png'))
+try:
+    writer.flush()
+    raise AssertionError('write error was not raised')
+except FileNotFoundError:
+    pass
+writer.close()
+
+
+#### REDUCED PRECISION TEST ####
+
+from models.utils.detect_face import get_model_dtype
+
+img = Image.open('data/multiface.jpg')
+boxes_ref, probs_ref = MTCNN(keep_all=True).detect(img)
+boxes_ref = np.stack(boxes_ref).astype(np.float32)
+for precision, dtype in [('bf16', torch.bfloat16), ('fp16', torch.float16)]:
+    for frozen in [False, True]:
+        mtcnn = MTCNN(keep_all=True, precision=precision, frozen=frozen)
+        assert get_model_dtype(mtcnn.pnet) == dtype
+        boxes_test, probs_test = mtcnn.detect(img)
+        boxes_test = np.stack(boxes_test).astype(np.float32)
+        assert len(boxes_test) == len(boxes_ref)
+        # every fp32 face is found again with a close box
+        iou = best_iou(boxes_ref, boxes_test)
+        print('{} (frozen={}) min box IoU: {:.3f}'.format(precision, frozen, iou.min()))
+        assert iou.min() > 0.8
+
+# each precision is a separate registry entry, and unsupported settings are rejected
+assert MTCNN(precision='bf16').pnet is not MTCNN().pnet
+for kwargs in [{'precision': 'int4'}, {'precision': 'bf16', 'backend': 'onnx'}]:
+    try:
+        MTCNN(**kwargs)
+        raise AssertionError('{} was accepted'.format(kwargs))
+    except ValueError:
+        pass
+
+
+#### PROFILING TEST ####
+
+from threading import Thread
+from models.utils import profiling
+
+img = Image.open('data/multiface.jpg')
+mtcnn = MTCNN(keep_all=True)
+boxes_ref, _ = mtcnn.detect(img)
+
+finished = []
+with profiling.profile(on_span=finished.append) as prof:
+    boxes_test, _ = mtcnn.detect(img)
+    # other threads do not report into this context's profile
+    thread = Thread(target=mtcnn.detect, args=(img,))
+    thread.start()
+    thread.join()
+print(prof.report())
+
+assert np.array_equal(np.stack(boxes_ref), np.stack(boxes_test))
+assert len(finished) == len(prof.spans)
+assert prof.calls()['detect'] == 1
+totals = prof.totals()
+for name in ['prepare', 'pnet', 'pnet/pyramid', 'pnet/net', 'pnet/nms', 'rnet/crop', 'rnet/net',
+             'onet/net', 'onet/nms']:
+    assert 0 < totals[name] <= totals['detect'], name
+counters = prof.counters
+assert counters['pnet/candidates'] >= counters['pnet/boxes'] >= counters['rnet/boxes']
+assert counters['rnet/boxes'] >= counters['onet/boxes'] == len(boxes_ref)
+
+# nothing is collected outside a profile
+assert profiling.active() is None
+with profiling.profile() as outer:
+    with profiling.profile() as inner:
+        mtcnn.detect(img)
+    assert not outer.spans and inner.spans
+
+
+#### NO-FACE TEST ####
+
+# without PNet candidates the summed-area table for RNet/ONet crops is never built
+img = Image.new('RGB', (512, 512))
+mtcnn = MTCNN(keep_all=True)
+mtcnn.detect(img)
+plan, = mtcnn.plan_cache._plans.values()
+assert 'image' in plan.buffers and 'integral' not in plan.buffers
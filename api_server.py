@@ -14,25 +14,141 @@ Run with:
     python api_server.py
 """
 
-from flask import Flask, request, jsonify
-import cv2
+from flask import Flask, request, jsonify, send_file, url_for
 import numpy as np
 import base64
+import binascii
+import bisect
+import hmac
 import pickle
 import os
-from face_processor import FaceProcessor   # your existing class
+import threading
+import time
+
+from live_profiler import LiveProfiler
 
 # ------------------------------------------------------------------
 # initialisation
 # ------------------------------------------------------------------
 app = Flask(__name__)
-processor = FaceProcessor()                # loads MTCNN + MobileFaceNet
 DB_PATH = "face_database.pkl"
 THRESHOLD = 0.55                           # adjust as you like (0–1)
+DETECTION_PRESET = None                    # "selfie", "enrollment", "turnstile", "crowd" or None
+DETECTION_MEMORY_MB = None                 # per-image detection memory budget (tiles large uploads)
+FROZEN_MODELS = True                       # frozen TorchScript models (compiled on first start)
+SINGLE_FACE = True                         # stop detection once the largest face is found
+PROFILE_REQUESTS = False                   # add per-stage timings to the "detection" object of responses
+DEBUG_TOKEN = os.environ.get("FACEAUTH_DEBUG_TOKEN")   # enables /debug/profile when set
+PROFILE_MAX_SECONDS = 60                   # longest /debug/profile session
+USERS_PAGE_SIZE = 100                      # default and maximum /users page sizes
+USERS_MAX_PAGE_SIZE = 1000
+WARMUP_ATTEMPTS = 5                        # warm-up tries before giving up until the next /ready
+WARMUP_RETRY_SECONDS = 2                   # delay before the first retry, doubled after each
+live_profiler = LiveProfiler(trace_path="profile_trace.json", max_requests=50)
+
+# torch, cv2 and the models are only loaded when the processor is first
+# needed, so importing this module stays cheap.
+_processor = None
+_processor_lock = threading.Lock()
+_ready = threading.Event()                 # set once warm-up has finished
+_warmup = {"running": False, "attempts": 0, "ms": None, "steps": None, "error": None}
+_warmup_lock = threading.Lock()
+
+# Sorted names of the enrolled users, so /status and /users never unpickle
+# the gallery. Rebuilt only when DB_PATH changes on disk behind our back
+# (e.g. written by another worker process).
+_user_index = []
+_user_index_mtime = None
+_user_index_lock = threading.Lock()
+_db_lock = threading.Lock()                # serialises load-modify-save of DB_PATH
+
+def get_processor():
+    """Create the shared FaceProcessor (MTCNN + MobileFaceNet) on first use."""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                from face_processor import FaceProcessor   # your existing class
+                # threads, batch size, pyramid factor and detection resolution
+                # come from runtime_profile.json if autotune.py has been run
+                _processor = FaceProcessor.from_profile(
+                    preset=DETECTION_PRESET, max_memory_mb=DETECTION_MEMORY_MB,
+                    frozen=FROZEN_MODELS, single_face=SINGLE_FACE
+                )
+    return _processor
+
+def start_warmup() -> None:
+    """
+    Build the user index, load the models and run FaceProcessor.warmup()
+    in a background thread; /ready reports 200 when it is done. A failed
+    attempt is retried with exponential backoff, up to WARMUP_ATTEMPTS
+    times; after that the next call (e.g. the next /ready probe) starts
+    over. Does nothing while warm-up is running or once it succeeded.
+    """
+    with _warmup_lock:
+        if _warmup["running"] or _ready.is_set():
+            return
+        _warmup["running"] = True
+
+    def run():
+        delay = WARMUP_RETRY_SECONDS
+        for attempt in range(1, WARMUP_ATTEMPTS + 1):
+            _warmup["attempts"] += 1
+            try:
+                start = time.perf_counter()
+                user_index()
+                steps = get_processor().warmup()
+                _warmup["ms"] = round((time.perf_counter() - start) * 1000, 1)
+                _warmup["steps"] = steps
+                _warmup["error"] = None
+                print(f"[READY] warm-up finished in {_warmup['ms']:.0f} ms")
+                _ready.set()
+                break
+            except Exception as e:
+                _warmup["error"] = str(e)
+                print(f"[WARMUP ERROR] attempt {attempt}/{WARMUP_ATTEMPTS}: {str(e)}")
+                if attempt < WARMUP_ATTEMPTS:
+                    time.sleep(delay)
+                    delay *= 2
+        with _warmup_lock:
+            _warmup["running"] = False
+
+    threading.Thread(target=run, name="warmup", daemon=True).start()
 
 # ------------------------------------------------------------------
 # utility helpers
 # ------------------------------------------------------------------
+def extract_template(frame, detection):
+    """
+    get_processor().get_template(frame), filling `detection` with the
+    detector stats and, if PROFILE_REQUESTS is set, a "profile" of the
+    time spent in each stage and the boxes surviving each stage.
+    """
+    processor = get_processor()
+    if not PROFILE_REQUESTS:
+        return processor.get_template(frame, stats=detection)
+    from facenet_pytorch.models.utils import profiling
+    with profiling.profile() as prof:
+        result = processor.get_template(frame, stats=detection)
+    detection["profile"] = prof.as_dict()
+    return result
+
+def debug_authorised() -> bool:
+    """
+    True if the request carries DEBUG_TOKEN in its X-Debug-Token header
+    (never in the URL, which ends up in access and proxy logs).
+    """
+    token = request.headers.get("X-Debug-Token", "")
+    return hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode())
+
+def debug_denied():
+    """Error response for /debug requests that may not proceed, or None."""
+    if DEBUG_TOKEN is None:
+        return jsonify({"error": "Not found"}), 404
+    if not debug_authorised():
+        return jsonify({"error": "Invalid debug token"}), 403
+    return None
+
 def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
     """
     Pure-NumPy cosine similarity for two 1-D vectors.
@@ -61,11 +177,46 @@ def save_database(db: dict) -> None:
     with open(DB_PATH, "wb") as f:
         pickle.dump(db, f)
 
+def db_mtime():
+    """Modification time of DB_PATH in ns, or None if there is no database yet."""
+    try:
+        return os.stat(DB_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def user_index() -> list:
+    """
+    Sorted list of enrolled names. Treat it as read-only: updates replace
+    the list, so a caller's copy stays consistent.
+    """
+    global _user_index, _user_index_mtime
+    mtime = db_mtime()
+    with _user_index_lock:
+        if mtime != _user_index_mtime:
+            _user_index = sorted(load_database())
+            _user_index_mtime = mtime
+        return _user_index
+
+def index_database(db: dict) -> None:
+    """Rebuild the index from the database just written (call after save_database)."""
+    global _user_index, _user_index_mtime
+    with _user_index_lock:
+        _user_index = sorted(db)
+        _user_index_mtime = db_mtime()
+
+def encode_cursor(name: str) -> str:
+    return base64.urlsafe_b64encode(name.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> str:
+    return base64.b64decode(cursor.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+
 def decode_image(data_uri: str) -> np.ndarray:
     """
     Convert a data-URI base64 string ("data:image/jpeg;base64,...")
     to a BGR OpenCV image.
     """
+    import cv2
+
     header, b64data = data_uri.split(",", 1)
     img_data = base64.b64decode(b64data)
     nparr = np.frombuffer(img_data, np.uint8)
@@ -75,6 +226,7 @@ def decode_image(data_uri: str) -> np.ndarray:
 # API endpoints
 # ------------------------------------------------------------------
 @app.route("/enroll", methods=["POST"])
+@live_profiler.profiled
 def enroll():
     data = request.get_json(force=True) or {}
     user_name = data.get("name")
@@ -85,21 +237,25 @@ def enroll():
 
     try:
         frame = decode_image(image_b64)
-        template, _ = processor.get_template(frame)
+        detection = {}
+        template, _ = extract_template(frame, detection)
 
         if template is None:
-            return jsonify({"error": "No face detected"}), 400
+            return jsonify({"error": "No face detected", "detection": detection}), 400
 
         template = l2_normalise(template)           # ensure unit length
 
-        db = load_database()
-        db[user_name] = {"template": template}
-        save_database(db)
+        with _db_lock:
+            db = load_database()
+            db[user_name] = {"template": template}
+            save_database(db)
+            index_database(db)
 
         print(f"[ENROLL] {user_name} stored.")
         return jsonify({
             "success": True,
-            "message": f"User '{user_name}' enrolled successfully."
+            "message": f"User '{user_name}' enrolled successfully.",
+            "detection": detection
         })
     except Exception as e:
         print(f"[ENROLL ERROR] {str(e)}")
@@ -107,6 +263,7 @@ def enroll():
 
 
 @app.route("/verify", methods=["POST"])
+@live_profiler.profiled
 def verify():
     data = request.get_json(force=True) or {}
     image_b64 = data.get("image")
@@ -116,7 +273,8 @@ def verify():
 
     try:
         frame = decode_image(image_b64)
-        live_template, _ = processor.get_template(frame)
+        detection = {}
+        live_template, _ = extract_template(frame, detection)
 
         if live_template is None:
             return jsonify({
@@ -125,7 +283,8 @@ def verify():
                 "cosine_similarity": 0.0,
                 "threshold": THRESHOLD,
                 "verified": False,
-                "message": "No face detected in the image"
+                "message": "No face detected in the image",
+                "detection": detection
             })
 
         live_template = l2_normalise(live_template)
@@ -167,7 +326,8 @@ def verify():
             "threshold": THRESHOLD,
             "verified": is_verified,
             "message": f"Best match: {best_name} with similarity {best_score:.4f}" if is_verified 
-                      else f"No sufficient match found. Best similarity: {best_score:.4f}"
+                      else f"No sufficient match found. Best similarity: {best_score:.4f}",
+            "detection": detection
         }
 
         print(f"[VERIFY] Result: {best_name} (similarity: {best_score:.4f}, verified: {is_verified})")
@@ -180,16 +340,135 @@ def verify():
 
 @app.route("/status", methods=["GET"])
 def status():
-    """Health check endpoint"""
-    db = load_database()
+    """Health check endpoint (counts only; list names with /users)"""
     return jsonify({
         "status": "running",
-        "enrolled_users": len(db),
+        "enrolled_users": len(user_index()),
         "threshold": THRESHOLD,
-        "users": list(db.keys()) if db else []
+        "ready": _ready.is_set()
+    })
+
+
+@app.route("/users", methods=["GET"])
+def users():
+    """
+    Enrolled names in sorted order, one page at a time:
+    /users?limit=100&prefix=ann&cursor=<next_cursor of the previous page>.
+    """
+    prefix = request.args.get("prefix", "")
+    try:
+        limit = int(request.args.get("limit", USERS_PAGE_SIZE))
+        after = decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
+    except (ValueError, binascii.Error):
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+    if not 1 <= limit <= USERS_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be in [1, {USERS_MAX_PAGE_SIZE}]"}), 400
+
+    index = user_index()
+    start = bisect.bisect_left(index, prefix)
+    if after is not None:
+        start = max(start, bisect.bisect_right(index, after))
+    page = []
+    for name in index[start:start + limit]:
+        if not name.startswith(prefix):
+            break
+        page.append(name)
+    end = start + len(page)
+    more = len(page) == limit and end < len(index) and index[end].startswith(prefix)
+    return jsonify({
+        "users": page,
+        "next_cursor": encode_cursor(page[-1]) if more else None
     })
 
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """
+    Readiness probe: 200 once the models are loaded and warmed up, 503
+    before, with the last warm-up error if an attempt failed. Starts
+    warm-up if it is not running (the server did not start it, or every
+    attempt failed).
+    """
+    if _ready.is_set():
+        return jsonify({"ready": True, "warmup_ms": _warmup["ms"], "warmup": _warmup["steps"]})
+    start_warmup()
+    return jsonify({
+        "ready": False,
+        "warming_up": _warmup["running"],
+        "attempts": _warmup["attempts"],
+        "error": _warmup["error"]
+    }), 503
+
+
+@app.route("/debug/profile", methods=["POST"])
+def debug_profile():
+    """
+    Start profiling the /enroll and /verify traffic of the next `seconds`
+    seconds with cProfile, torch.profiler and the detection stage spans.
+    Returns 202 at once, with the URLs of the report and the Chrome trace;
+    no worker waits for the profile. Disabled unless FACEAUTH_DEBUG_TOKEN
+    is set.
+    """
+    denied = debug_denied()
+    if denied:
+        return denied
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        return jsonify({"error": "seconds must be a number"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"seconds must be in (0, {PROFILE_MAX_SECONDS}]"}), 400
+
+    session = live_profiler.start(seconds)
+    if session is None:
+        return jsonify({"error": "A profile is already running"}), 409
+    print(f"[PROFILE] profiling the next {seconds:g}s of traffic")
+    return jsonify({
+        "started": session.started,
+        "seconds": seconds,
+        "report": url_for("debug_profile_report"),
+        "trace": url_for("debug_profile_trace")
+    }), 202
+
+
+@app.route("/debug/profile/report", methods=["GET"])
+def debug_profile_report():
+    """
+    Report of the last /debug/profile: 202 with the remaining time while
+    it runs, then the hottest Python functions and torch operators (`top`
+    of each, default 30) and the detection stages.
+    """
+    denied = debug_denied()
+    if denied:
+        return denied
+    try:
+        top = int(request.args.get("top", 30))
+    except ValueError:
+        return jsonify({"error": "top must be a number"}), 400
+    report = live_profiler.report(top=top)
+    if report is None:
+        return jsonify({"error": "No profile has been started"}), 404
+    if report["running"]:
+        return jsonify(report), 202
+    report["trace"] = url_for("debug_profile_trace")
+    return jsonify(report)
+
+
+@app.route("/debug/profile/trace", methods=["GET"])
+def debug_profile_trace():
+    """Chrome trace (chrome://tracing, Perfetto) of the last /debug/profile."""
+    denied = debug_denied()
+    if denied:
+        return denied
+    report = live_profiler.report(top=0)          # finishes a session that has ended
+    if report is None:
+        return jsonify({"error": "No profile has been started"}), 404
+    if report["running"]:
+        return jsonify(report), 202
+    path = os.path.abspath(live_profiler.trace_path)
+    return send_file(path, mimetype="application/json", as_attachment=True)
+
+
 # ------------------------------------------------------------------
 # run
 # ------------------------------------------------------------------
@@ -200,7 +479,18 @@ if __name__ == "__main__":
     print("  POST /enroll - Enroll a new face")
     print("  POST /verify - Verify a face")
     print("  GET /status - Check server status")
-    
+    print("  GET /ready - 200 once the models are warmed up")
+    print("  GET /users?prefix=&limit=&cursor= - List enrolled users")
+    if DEBUG_TOKEN is not None:
+        print("  POST /debug/profile?seconds=N - Profile live traffic (token protected)")
+
+    # With the reloader this module runs twice: in a watcher process that
+    # only restarts the server on code changes, and in the child that
+    # serves requests (WERKZEUG_RUN_MAIN set). Only the child warms up.
+    debug = True
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warmup()                     # load and warm up the models; see /ready
+
     # host='0.0.0.0' makes it reachable on your LAN; change to 127.0.0.1
     # if you only need local access.
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5000, debug=debug, use_reloader=debug)
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""
+autotune.py
+-----------
+Tune FaceProcessor's runtime settings for the host it runs on.
+
+1. Every (factor, detect_resolution) pair in the grid is checked against
+   the default settings (factor 0.709, full resolution): each image must
+   give the same face/no-face result and a template with cosine
+   >= --min-cosine to the default one. Pairs that fail are dropped; the
+   default pair itself is always kept, even if --factors omits it.
+2. End-to-end get_template latency (median over the images and
+   --repeat runs) is measured for every remaining pair at every thread
+   count, and the fastest (num_threads, factor, detect_resolution) wins.
+3. With those settings, get_templates throughput (images/s) is measured
+   for every batch size and the highest one wins.
+
+The server's model and detection options (DETECTION_PRESET,
+DETECTION_MEMORY_MB, FROZEN_MODELS and SINGLE_FACE in api_server.py) are
+used throughout. The chosen settings, with frozen and single_face, and
+every measurement are written to a profile (default: runtime_profile.json)
+that FaceProcessor.from_profile() and api_server.py load at start-up. Rerun it after moving to other hardware.
+
+Run with:
+    python autotune.py [--image-dir path/to/faces] [--threads 1 2 4] [--quick]
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from api_server import DETECTION_MEMORY_MB, DETECTION_PRESET, FROZEN_MODELS, SINGLE_FACE
+from face_processor import PYENGINE_DIR, RUNTIME_PROFILE, FaceProcessor
+
+DEFAULT_FACES = os.path.join(PYENGINE_DIR, "facenet_pytorch", "data", "test_images")
+DEFAULT_FACTOR = 0.709
+
+
+def load_images(image_dir):
+    """BGR images under image_dir, as the server decodes them."""
+    paths = [
+        p for ext in ("jpg", "jpeg", "png")
+        for p in glob.glob(os.path.join(image_dir, "**", f"*.{ext}"), recursive=True)
+    ]
+    images = [img for img in (cv2.imread(p) for p in sorted(paths)) if img is not None]
+    if not images:
+        raise RuntimeError(f"No images found under {image_dir}")
+    return images
+
+
+def default_threads():
+    cpus = os.cpu_count() or 1
+    return sorted({t for t in (1, 2, 4, cpus // 2, cpus) if 1 <= t <= cpus})
+
+
+def templates(processor, images):
+    return [processor.get_template(img)[0] for img in images]
+
+
+def agrees(reference, candidate, min_cosine):
+    """Same face/no-face result on every image and template cosine >= min_cosine."""
+    for ref, found in zip(reference, candidate):
+        if (ref is None) != (found is None):
+            return False
+        if ref is not None:
+            a, b = ref.flatten(), found.flatten()
+            if np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)) < min_cosine:
+                return False
+    return True
+
+
+def latency_ms(processor, images, repeat):
+    """Median end-to-end get_template time over images and repeats."""
+    times = []
+    for _ in range(repeat):
+        for img in images:
+            start = time.perf_counter()
+            processor.get_template(img)
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def throughput(processor, images, repeat):
+    """get_templates images per second, best of repeat runs."""
+    processor.get_templates(images)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        processor.get_templates(images)
+        best = min(best, time.perf_counter() - start)
+    return len(images) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune FaceProcessor runtime settings for this host.")
+    parser.add_argument("--image-dir", default=DEFAULT_FACES)
+    parser.add_argument("--threads", type=int, nargs="+", default=default_threads())
+    parser.add_argument("--factors", type=float, nargs="+", default=[0.6, 0.65, DEFAULT_FACTOR])
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[0, 1280, 960, 640],
+                        help="detect_resolution values to try (0 = full resolution)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--min-cosine", type=float, default=0.98,
+                        help="template agreement required with the default settings")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true",
+                        help="one repeat and only the default and highest thread counts")
+    parser.add_argument("--output", default=RUNTIME_PROFILE)
+    args = parser.parse_args()
+    if args.quick:
+        args.repeat = 1
+        args.threads = sorted({torch.get_num_threads(), max(args.threads)})
+
+    images = load_images(args.image_dir)
+    options = dict(preset=DETECTION_PRESET, max_memory_mb=DETECTION_MEMORY_MB,
+                   frozen=FROZEN_MODELS, single_face=SINGLE_FACE)
+    baseline = FaceProcessor(**options)
+    reference = templates(baseline, images)
+    baseline_ms = latency_ms(baseline, images, args.repeat)
+    print(f"--- {len(images)} images, default settings: {baseline_ms:.1f} ms ---")
+
+    # 1. settings that change detection must keep the default templates; the defaults
+    # themselves are the reference, so there is always at least one candidate
+    candidates = [(DEFAULT_FACTOR, None)]
+    for factor in args.factors:
+        for resolution in args.resolutions:
+            if (factor, resolution or None) in candidates:
+                continue
+            processor = FaceProcessor(factor=factor, detect_resolution=resolution or None, **options)
+            if agrees(reference, templates(processor, images), args.min_cosine):
+                candidates.append((factor, resolution or None))
+            else:
+                print(f"[AUTOTUNE] factor={factor} detect_resolution={resolution}: rejected")
+
+    # 2. end-to-end latency over threads x accepted detection settings
+    results = []
+    for threads in args.threads:
+        for factor, resolution in candidates:
+            processor = FaceProcessor(
+                factor=factor, detect_resolution=resolution, num_threads=threads, **options
+            )
+            ms = latency_ms(processor, images, args.repeat)
+            results.append({
+                "num_threads": threads, "factor": factor, "detect_resolution": resolution,
+                "latency_ms": ms,
+            })
+            print(f"[AUTOTUNE] threads={threads} factor={factor} "
+                  f"detect_resolution={resolution}: {ms:.1f} ms")
+    best = min(results, key=lambda r: r["latency_ms"])
+
+    # 3. micro-batch size for get_templates with the fastest settings
+    workload = (images * max(args.batch_sizes))[:max(2 * max(args.batch_sizes), len(images))]
+    batches = []
+    for batch_size in args.batch_sizes:
+        processor = FaceProcessor(
+            factor=best["factor"], detect_resolution=best["detect_resolution"],
+            num_threads=best["num_threads"], batch_size=batch_size, **options
+        )
+        ips = throughput(processor, workload, args.repeat)
+        batches.append({"batch_size": batch_size, "images_per_s": ips})
+        print(f"[AUTOTUNE] batch_size={batch_size}: {ips:.2f} images/s")
+    best_batch = max(batches, key=lambda r: r["images_per_s"])
+
+    profile = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {
+            "cpu_count": os.cpu_count(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "torch": torch.__version__,
+        },
+        "config": {
+            "num_threads": best["num_threads"],
+            "batch_size": best_batch["batch_size"],
+            "factor": best["factor"],
+            "detect_resolution": best["detect_resolution"],
+            "frozen": FROZEN_MODELS,
+            "single_face": SINGLE_FACE,
+        },
+        "baseline_latency_ms": baseline_ms,
+        "latency_ms": best["latency_ms"],
+        "images_per_s": best_batch["images_per_s"],
+        "images": len(images),
+        "min_cosine": args.min_cosine,
+        "latency": results,
+        "batches": batches,
+    }
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(json.dumps(profile["config"], indent=2))
+    print(f"[AUTOTUNE] {baseline_ms:.1f} -> {best['latency_ms']:.1f} ms per image; "
+          f"profile written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
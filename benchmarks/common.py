@@ -0,0 +1,41 @@
+"""
+Shared helpers for the benchmark scripts.
+
+Run benchmarks from the repository root as modules, e.g.
+    python -m benchmarks.frozen_startup
+"""
+
+import glob
+import os
+import statistics
+import time
+
+import cv2
+
+from face_processor import PYENGINE_DIR
+
+FACENET_DATA = os.path.join(PYENGINE_DIR, "facenet_pytorch", "data")
+
+
+def test_images():
+    """Paths of the bundled facenet_pytorch test images (one face each)."""
+    return sorted(glob.glob(os.path.join(FACENET_DATA, "test_images", "*", "*.jpg")))
+
+
+def load_bgr(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise FileNotFoundError(f"Cannot read {path}")
+    return img
+
+
+def time_call(fn, repeat=20, warmup=3):
+    """Median wall time of `fn()` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
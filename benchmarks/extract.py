@@ -0,0 +1,69 @@
+"""
+Batched face extraction and background crop writes against the per-face
+extract_face loop.
+
+Detects the faces in multiface.jpg once and times MTCNN.extract's work for
+them: the old per-face loop, extract_faces without saving, and both with
+every crop saved as PNG, synchronously or through a BackgroundWriter
+(the time until the call returns, and until the writes are flushed).
+
+    python -m benchmarks.extract --image-size 112
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmarks.common import FACENET_DATA, time_call
+from facenet_pytorch import MTCNN, BackgroundWriter, extract_face, extract_faces
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Face extraction benchmark.")
+    parser.add_argument("--image-size", type=int, default=160)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    img = Image.open(os.path.join(FACENET_DATA, "multiface.jpg"))
+    boxes, _ = MTCNN(keep_all=True).detect(img)
+    boxes = np.asarray(boxes, dtype=np.float32)
+    out_dir = tempfile.mkdtemp()
+    paths = [os.path.join(out_dir, f"face_{i}.png") for i in range(len(boxes))]
+
+    images = {"PIL": img, "numpy": np.array(img), "tensor": torch.as_tensor(np.array(img))}
+    for name, image in images.items():
+        loop_ms = time_call(
+            lambda: torch.stack([extract_face(image, box, args.image_size) for box in boxes]),
+            repeat=args.repeat
+        )
+        batch_ms = time_call(lambda: extract_faces(image, boxes, args.image_size), repeat=args.repeat)
+        print(f"{name:<7} {len(boxes)} faces: loop {loop_ms:.2f} ms, batched {batch_ms:.2f} ms")
+
+    sync_ms = time_call(lambda: extract_faces(img, boxes, args.image_size, save_paths=paths),
+                        repeat=args.repeat)
+    with BackgroundWriter(max_workers=args.workers) as writer:
+        # Time one request's return with an idle writer, then the same until its crops are written
+        returned, flushed = [], []
+        for _ in range(args.repeat):
+            writer.flush()
+            start = time.perf_counter()
+            extract_faces(img, boxes, args.image_size, save_paths=paths, writer=writer)
+            returned.append((time.perf_counter() - start) * 1000)
+            writer.flush()
+            flushed.append((time.perf_counter() - start) * 1000)
+        async_ms, flushed_ms = statistics.median(returned), statistics.median(flushed)
+    print(f"saving PNGs: synchronous {sync_ms:.2f} ms, background {async_ms:.2f} ms to return "
+          f"({flushed_ms:.2f} ms until flushed)")
+    shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    main()
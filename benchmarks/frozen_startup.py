@@ -0,0 +1,83 @@
+"""
+Start-up time and steady-state latency of frozen TorchScript models
+against the eager path.
+
+Start-up is measured in fresh interpreters (import + FaceProcessor()),
+so it includes torch.load of every weight file on the eager path and
+torch.jit.load of the cached artifacts on the frozen path. Compile the
+artifacts first so the frozen run measures a warm cache:
+
+    python compile_models.py
+    python -m benchmarks.frozen_startup
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+import torch
+
+from benchmarks.common import load_bgr, test_images, time_call
+from face_processor import FaceProcessor
+
+STARTUP_SNIPPET = (
+    "import time; t = time.perf_counter(); "
+    "from face_processor import FaceProcessor; FaceProcessor(frozen={frozen}); "
+    "print('STARTUP', time.perf_counter() - t)"
+)
+
+
+def measure_startup(frozen, runs):
+    times = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP_SNIPPET.format(frozen=frozen)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        line = [l for l in out.splitlines() if l.startswith("STARTUP")][-1]
+        times.append(float(line.split()[1]) * 1000)
+    return statistics.median(times)
+
+
+def measure_steady_state(processor, repeat):
+    """Median latency (ms) of each network and of the full get_template path."""
+    inputs = {
+        "pnet": (processor.mtcnn.pnet, torch.rand(1, 3, 360, 480)),
+        "rnet": (processor.mtcnn.rnet, torch.rand(128, 3, 24, 24)),
+        "onet": (processor.mtcnn.onet, torch.rand(16, 3, 48, 48)),
+        "mobilefacenet": (processor.fr_model, torch.rand(1, 3, 112, 112)),
+    }
+    results = {}
+    with torch.no_grad():
+        for name, (net, x) in inputs.items():
+            x = x.to(processor.device)
+            results[name] = time_call(lambda: net(x), repeat=repeat)
+
+    images = [load_bgr(p) for p in test_images()]
+    results["get_template"] = time_call(
+        lambda: [processor.get_template(img) for img in images], repeat=max(repeat // 4, 1)
+    ) / len(images)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frozen vs eager model benchmark.")
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'':16s}{'eager':>12s}{'frozen':>12s}{'speedup':>10s}")
+    eager = measure_startup(False, args.startup_runs)
+    frozen = measure_startup(True, args.startup_runs)
+    print(f"{'startup':16s}{eager:10.1f}ms{frozen:10.1f}ms{eager / frozen:9.2f}x")
+
+    eager = measure_steady_state(FaceProcessor(frozen=False), args.repeat)
+    frozen = measure_steady_state(FaceProcessor(frozen=True), args.repeat)
+    for name in eager:
+        print(f"{name:16s}{eager[name]:10.2f}ms{frozen[name]:10.2f}ms"
+              f"{eager[name] / frozen[name]:9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Per-module import-time report for the serving and Android entry points.
+
+Each target is imported in a fresh interpreter with `python -X importtime`;
+the report lists its total import time and the slowest modules it pulls in.
+With --budget-ms the script exits non-zero when any target goes over budget,
+so cold start can be kept in check in CI.
+
+    python -m benchmarks.import_time --budget-ms 1000
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+from face_processor import PYENGINE_DIR
+
+# Import-only targets: none of them should load models or weights.
+TARGETS = [
+    "api_server",
+    "facenet_pytorch",
+    "face_module",
+    "face_processor",
+    "facenet_pytorch.models.mtcnn",
+]
+
+
+def import_times(module):
+    """{imported module: cumulative import time in ms} for a fresh `import module`."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [PYENGINE_DIR, os.getcwd(), env.get("PYTHONPATH", "")]
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time report.")
+    parser.add_argument("modules", nargs="*", default=TARGETS)
+    parser.add_argument("--top", type=int, default=8, help="slowest modules to list per target")
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        times = import_times(module)
+        total = times[module]
+        flag = ""
+        if args.budget_ms is not None and total > args.budget_ms:
+            over_budget.append(module)
+            flag = f"  OVER BUDGET ({args.budget_ms:.0f}ms)"
+        print(f"{module}: {total:.1f}ms{flag}")
+        slowest = sorted(
+            ((t, name) for name, t in times.items() if name != module), reverse=True
+        )[:args.top]
+        for t, name in slowest:
+            print(f"    {t:10.1f}ms  {name}")
+
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
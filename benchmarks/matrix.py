@@ -0,0 +1,224 @@
+"""
+Detection and embedding benchmark matrix with JSON baselines.
+
+Replaces the single number printed by facenet_pytorch/tests/perf_test.py
+(MTCNN on 512x512 images, batch 32) with one median time per case, in
+milliseconds per image (per call for the detect_face stages and align_face,
+per face for MobileFaceNet), over these groups:
+
+    resolution  MTCNN.detect on the test images resized to each --widths
+    batch       MTCNN.detect on 512x512 test images in batches of --batch-sizes
+    faces       detect and detect + extract on multiface.jpg against a
+                single-face image of the same size
+    pyramid     MTCNN.detect at 640 px for (min_face_size, factor) pairs
+    threads     MTCNN.detect at 640 px for each --threads
+    stages      PNet, RNet and ONet stages of detect_face, align_face and
+                MobileFaceNet (batch 1 and 8) on their own
+
+--save writes the results as a baseline, and --compare checks them against
+one, flagging every case more than --tolerance slower (exit status 1):
+
+    python -m benchmarks.matrix --save benchmarks/baselines/my-host.json
+    python -m benchmarks.matrix --compare benchmarks/baselines/my-host.json --tolerance 0.15
+    python -m benchmarks.matrix --groups stages threads --repeat 5
+
+Baselines only compare meaningfully on the host (and thread settings) that
+wrote them.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import torch
+
+from benchmarks.common import FACENET_DATA, load_bgr, test_images, time_call
+from face_processor import align_face, load_fr_model, to_face_tensor
+from facenet_pytorch import MTCNN
+from facenet_pytorch.models.utils.detect_face import (
+    image_batch, image_tensor, integral_image, onet_stage, pnet_stage,
+    pyramid_scales, rnet_stage
+)
+
+GROUPS = ("resolution", "batch", "faces", "pyramid", "threads", "stages")
+PYRAMIDS = [(20, 0.709), (40, 0.709), (80, 0.709), (20, 0.6), (20, 0.8)]
+
+
+def resize_width(img, width):
+    h, w = img.shape[:2]
+    return cv2.resize(img, (width, round(h * width / w)), interpolation=cv2.INTER_AREA)
+
+
+def per_image(fn, images, repeat):
+    """Median time of fn(image) over `images`, per image."""
+    return time_call(lambda: [fn(img) for img in images], repeat=repeat, warmup=1) / len(images)
+
+
+def resolution_cases(images, args):
+    mtcnn = MTCNN()
+    for width in args.widths:
+        frames = [resize_width(img, width) for img in images]
+        yield f"resolution/detect/w={width}", per_image(mtcnn.detect, frames, args.repeat)
+
+
+def batch_cases(images, args):
+    mtcnn = MTCNN()
+    frames = [cv2.resize(img, (512, 512), interpolation=cv2.INTER_AREA) for img in images]
+    for batch_size in args.batch_sizes:
+        batch = [frames[i % len(frames)] for i in range(batch_size)]
+        ms = time_call(lambda: mtcnn.detect(batch), repeat=args.repeat, warmup=1)
+        yield f"batch/detect/bs={batch_size}", ms / batch_size
+
+
+def faces_cases(images, args):
+    multi = cv2.cvtColor(load_bgr(os.path.join(FACENET_DATA, "multiface.jpg")), cv2.COLOR_BGR2RGB)
+    single = cv2.resize(images[0], (multi.shape[1], multi.shape[0]), interpolation=cv2.INTER_AREA)
+    mtcnn = MTCNN(keep_all=True, image_size=112)
+    for img in (single, multi):
+        boxes, _ = mtcnn.detect(img)
+        n = 0 if boxes is None else len(boxes)
+        yield f"faces/detect/n={n}", time_call(lambda: mtcnn.detect(img), repeat=args.repeat, warmup=1)
+        yield f"faces/extract/n={n}", time_call(lambda: mtcnn(img), repeat=args.repeat, warmup=1)
+
+
+def pyramid_cases(images, args):
+    frames = [resize_width(img, 640) for img in images]
+    for min_face_size, factor in PYRAMIDS:
+        mtcnn = MTCNN(min_face_size=min_face_size, factor=factor)
+        yield (f"pyramid/detect/min={min_face_size},factor={factor}",
+               per_image(mtcnn.detect, frames, args.repeat))
+
+
+def threads_cases(images, args):
+    frames = [resize_width(img, 640) for img in images]
+    mtcnn = MTCNN()
+    default = torch.get_num_threads()
+    try:
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            yield f"threads/detect/t={threads}", per_image(mtcnn.detect, frames, args.repeat)
+    finally:
+        torch.set_num_threads(default)
+
+
+def stage_cases(images, args):
+    mtcnn = MTCNN(keep_all=True)
+    frames = [resize_width(img, 640) for img in images]
+    imgs = image_tensor(image_batch(frames[0], "cpu"), torch.float32)
+    integral = integral_image(imgs)
+    scales = pyramid_scales(imgs.shape[2], imgs.shape[3], 20, 0.709)
+    t = mtcnn.thresholds
+
+    pnet_out = pnet_stage(imgs, scales, mtcnn.pnet, t[0])
+    rnet_out = rnet_stage(integral, pnet_out[0].clone(), pnet_out[1].clone(), mtcnn.rnet, t[1],
+                          torch.float32)
+    yield "stages/pnet", time_call(lambda: pnet_stage(imgs, scales, mtcnn.pnet, t[0]),
+                                   repeat=args.repeat, warmup=1)
+    yield "stages/rnet", time_call(
+        lambda: rnet_stage(integral, pnet_out[0].clone(), pnet_out[1].clone(), mtcnn.rnet, t[1],
+                           torch.float32),
+        repeat=args.repeat, warmup=1
+    )
+    yield "stages/onet", time_call(
+        lambda: onet_stage(integral, rnet_out[0].clone(), rnet_out[1].clone(), mtcnn.onet, t[2],
+                           torch.float32, "cpu"),
+        repeat=args.repeat, warmup=1
+    )
+
+    _, _, points = mtcnn.detect(frames[0], landmarks=True)
+    landmarks = points[0].astype("float32")
+    yield "stages/align", time_call(lambda: align_face(frames[0], landmarks), repeat=args.repeat)
+
+    fr_model = load_fr_model()
+    face = to_face_tensor(align_face(frames[0], landmarks))
+
+    def embed(batch):
+        with torch.no_grad():
+            return fr_model(batch)
+
+    for batch_size in (1, 8):
+        batch = face.repeat(batch_size, 1, 1, 1)
+        yield (f"stages/mobilefacenet/bs={batch_size}",
+               time_call(lambda: embed(batch), repeat=args.repeat) / batch_size)
+
+
+CASES = {
+    "resolution": resolution_cases,
+    "batch": batch_cases,
+    "faces": faces_cases,
+    "pyramid": pyramid_cases,
+    "threads": threads_cases,
+    "stages": stage_cases,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Print every case against the baseline and return the names of the slower ones."""
+    slower = []
+    print(f"\n{'case':<42} {'baseline':>9} {'now':>9} {'change':>8}")
+    for name, ms in results.items():
+        if name not in baseline:
+            print(f"{name:<42} {'-':>9} {ms:>9.2f}      new")
+            continue
+        change = ms / baseline[name] - 1
+        flag = "  SLOWER" if change > tolerance else ""
+        print(f"{name:<42} {baseline[name]:>9.2f} {ms:>9.2f} {change:>+7.1%}{flag}")
+        if flag:
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detection and embedding benchmark matrix.")
+    parser.add_argument("--groups", nargs="+", choices=GROUPS, default=list(GROUPS))
+    parser.add_argument("--widths", type=int, nargs="+", default=[320, 640, 1280])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=sorted({1, torch.get_num_threads()}))
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="baseline file to compare the results against")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="relative slowdown flagged by --compare")
+    args = parser.parse_args()
+
+    images = [cv2.cvtColor(load_bgr(path), cv2.COLOR_BGR2RGB) for path in test_images()]
+    results = {}
+    for group in args.groups:
+        for name, ms in CASES[group](images, args):
+            results[name] = ms
+            print(f"{name:<42} {ms:>9.2f} ms")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "host": {
+                    "cpu_count": os.cpu_count(),
+                    "machine": platform.machine(),
+                    "processor": platform.processor(),
+                    "torch": torch.__version__,
+                    "threads": torch.get_num_threads(),
+                },
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2)
+        print(f"\nBaseline written to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            print(f"\n{len(slower)} case(s) more than {args.tolerance:.0%} slower than {args.compare}")
+            sys.exit(1)
+        print(f"\nNo case more than {args.tolerance:.0%} slower than {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
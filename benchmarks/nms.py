@@ -0,0 +1,70 @@
+"""
+Torch matrix NMS against the NumPy while-loop NMS on real MTCNN candidates.
+
+multiface.jpg is run through the detector at a few widths with low
+thresholds (a dense scene) and the boxes that reach each NMS call are
+recorded. Both implementations are then timed on those candidate sets
+with the 'Min' and 'Union' overlap measures and checked for identical picks.
+
+    python -m benchmarks.nms
+"""
+
+import argparse
+import os
+
+import cv2
+import torch
+
+from benchmarks.common import FACENET_DATA, load_bgr, time_call
+from facenet_pytorch import MTCNN
+from facenet_pytorch.models.utils import detect_face as df
+
+
+def record_candidates(mtcnn, img):
+    """Arguments of every NMS call made while detecting faces in `img`."""
+    calls = []
+    batched_nms, batched_nms_torch = df.batched_nms, df.batched_nms_torch
+
+    def record(fn):
+        def wrapper(boxes, scores, idxs, *args, **kwargs):
+            calls.append((boxes.clone(), scores.clone(), idxs.clone()))
+            return fn(boxes, scores, idxs, *args, **kwargs)
+        return wrapper
+
+    df.batched_nms, df.batched_nms_torch = record(batched_nms), record(batched_nms_torch)
+    try:
+        mtcnn.detect(img)
+    finally:
+        df.batched_nms, df.batched_nms_torch = batched_nms, batched_nms_torch
+    return calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NMS benchmark.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[640, 1280, 1920])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    mtcnn = MTCNN(keep_all=True, thresholds=[0.5, 0.5, 0.5])
+    image = cv2.cvtColor(load_bgr(os.path.join(FACENET_DATA, "multiface.jpg")), cv2.COLOR_BGR2RGB)
+
+    print(f"{'width':>6} {'boxes':>6} {'method':>6} {'numpy ms':>9} {'torch ms':>9} {'speedup':>8}")
+    for width in args.widths:
+        img = cv2.resize(image, (width, image.shape[0] * width // image.shape[1]))
+        # the largest candidate set per image size (the cross-scale NMS after PNet)
+        boxes, scores, idxs = max(record_candidates(mtcnn, img), key=lambda c: len(c[0]))
+        boxes = boxes[:, :4].contiguous()
+        for method in ["Min", "Union"]:
+            ref = df.batched_nms_numpy(boxes, scores, idxs, 0.7, method)
+            out = df.batched_nms_torch(boxes, scores, idxs, 0.7, method)
+            assert torch.equal(ref, out), "torch NMS picks differ from nms_numpy"
+            numpy_ms = time_call(lambda: df.batched_nms_numpy(boxes, scores, idxs, 0.7, method),
+                                 repeat=args.repeat)
+            torch_ms = time_call(lambda: df.batched_nms_torch(boxes, scores, idxs, 0.7, method),
+                                 repeat=args.repeat)
+            print(f"{width:>6} {len(boxes):>6} {method:>6} {numpy_ms:>9.2f} {torch_ms:>9.2f} "
+                  f"{numpy_ms / torch_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Packed single-pass PNet against one PNet pass per pyramid level.
+
+Each upload size is run through the full detector with both pyramid
+modes. Reports median detection latency, the PNet pixels each mode
+processes (the packed canvas includes gutters and unused corners) and
+the canvas fill, and checks that both modes find the same faces.
+
+    python -m benchmarks.packed_pyramid
+"""
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+from benchmarks.common import FACENET_DATA, load_bgr, time_call
+from facenet_pytorch import MTCNN
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Packed PNet pyramid benchmark.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[320, 640, 1280, 1920])
+    parser.add_argument("--batch", type=int, default=1, help="images per detect() call")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    levels = MTCNN(keep_all=True)
+    packed = MTCNN(keep_all=True, packed_pyramid=True)
+    image = cv2.cvtColor(load_bgr(os.path.join(FACENET_DATA, "multiface.jpg")), cv2.COLOR_BGR2RGB)
+
+    print(f"{'size':>10} {'levels ms':>10} {'packed ms':>10} {'speedup':>8} {'scales':>7} {'fill':>5}")
+    for width in args.widths:
+        img = cv2.resize(image, (width, image.shape[0] * width // image.shape[1]))
+        batch = np.stack([img] * args.batch)
+        level_stats, packed_stats = {}, {}
+        level_boxes, _ = levels.detect(batch, stats=level_stats)
+        packed_boxes, _ = packed.detect(batch, stats=packed_stats)
+        for a, b in zip(level_boxes, packed_boxes):
+            same = a is None if b is None else np.allclose(a.astype(float), b.astype(float), atol=1e-2)
+            assert same, "packed pyramid changed the detections"
+
+        levels_ms = time_call(lambda: levels.detect(batch), repeat=args.repeat, warmup=1)
+        packed_ms = time_call(lambda: packed.detect(batch), repeat=args.repeat, warmup=1)
+        fill = level_stats["pnet_pixels"] / packed_stats["pnet_pixels"]
+        size = f"{img.shape[1]}x{img.shape[0]}"
+        print(f"{size:>10} {levels_ms:>10.0f} {packed_ms:>10.0f} {levels_ms / packed_ms:>7.2f}x "
+              f"{level_stats['scales']:>7} {fill:>5.0%}")
+
+
+if __name__ == "__main__":
+    main()
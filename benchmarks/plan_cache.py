@@ -0,0 +1,43 @@
+"""
+Detection with and without the resolution-keyed plan cache on a stream of
+same-sized frames, the case the cache is meant for (camera frames, resized
+uploads).
+
+For each frame width, times MTCNN.detect on the test images resized to that
+width with plan_cache_size=0 and with the default cache, and reports the
+cache's hit statistics.
+
+    python -m benchmarks.plan_cache --widths 320 640 1280
+"""
+
+import argparse
+
+import cv2
+
+from benchmarks.common import load_bgr, test_images, time_call
+from facenet_pytorch import MTCNN
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detection plan cache benchmark.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[320, 640, 1280])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--packed", action="store_true", help="use packed_pyramid=True")
+    args = parser.parse_args()
+
+    images = [cv2.cvtColor(load_bgr(path), cv2.COLOR_BGR2RGB) for path in test_images()]
+    print(f"{'width':>6} {'no cache ms':>12} {'cache ms':>9} {'speedup':>8} {'hits':>6} {'misses':>7}")
+    for width in args.widths:
+        frames = [cv2.resize(img, (width, width * 3 // 4)) for img in images]
+        row = {}
+        for size in (0, 8):
+            mtcnn = MTCNN(plan_cache_size=size, packed_pyramid=args.packed)
+            row[size] = time_call(lambda: [mtcnn.detect(frame) for frame in frames],
+                                  repeat=args.repeat, warmup=1) / len(frames)
+        info = mtcnn.plan_cache_info()
+        print(f"{width:>6} {row[0]:>12.1f} {row[8]:>9.1f} {row[0] / row[8]:>7.2f}x "
+              f"{info.hits:>6} {info.misses:>7}")
+
+
+if __name__ == "__main__":
+    main()
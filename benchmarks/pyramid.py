@@ -0,0 +1,58 @@
+"""
+uint8 OpenCV image pyramid against float area resampling from the full image.
+
+For each upload width, times building the PNet pyramid alone with both
+backends and the full MTCNN detection with each, and reports the IoU of
+the largest face found by both.
+
+    python -m benchmarks.pyramid
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+import torch
+
+from benchmarks.common import load_bgr, test_images, time_call
+from benchmarks.single_face import iou
+from facenet_pytorch import MTCNN
+from facenet_pytorch.models.utils.detect_face import pyramid_levels, pyramid_scales
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image pyramid backend benchmark.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[640, 1280, 0],
+                        help="resize uploads to these widths (0 = original size)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    detectors = {"torch": MTCNN(), "cv2": MTCNN(pyramid="cv2")}
+
+    print(f"{'image':<16} {'size':>10} {'torch pyr':>10} {'cv2 pyr':>8} {'torch det':>10} "
+          f"{'cv2 det':>8} {'IoU':>5}")
+    for path in test_images():
+        rgb = cv2.cvtColor(load_bgr(path), cv2.COLOR_BGR2RGB)
+        for width in args.widths:
+            img = rgb if width == 0 else cv2.resize(rgb, (width, rgb.shape[0] * width // rgb.shape[1]))
+            frames = torch.as_tensor(img)[None]
+            batch = frames.permute(0, 3, 1, 2).float()
+            h, w = img.shape[:2]
+            sizes = [(int(h * s + 1), int(w * s + 1)) for s in pyramid_scales(h, w, 20, 0.709)]
+
+            row = {}
+            for backend, mtcnn in detectors.items():
+                row[backend + " pyr"] = time_call(
+                    lambda: list(pyramid_levels(batch, sizes, backend, frames)), repeat=args.repeat
+                )
+                row[backend + " det"] = time_call(lambda: mtcnn.detect(img), repeat=args.repeat, warmup=1)
+            boxes = [mtcnn.detect(img)[0] for mtcnn in detectors.values()]
+            overlap = iou(boxes[0][0], boxes[1][0]) if all(b is not None for b in boxes) else np.nan
+
+            name = path.split("/")[-2][:16]
+            print(f"{name:<16} {f'{w}x{h}':>10} {row['torch pyr']:>10.1f} {row['cv2 pyr']:>8.1f} "
+                  f"{row['torch det']:>10.0f} {row['cv2 det']:>8.0f} {overlap:>5.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Vectorized MTCNN.select_boxes against the per-image loop it replaced.
+
+Builds synthetic detect() output (0-12 faces per image, some images
+without faces) for each batch size and times both implementations for
+every selection method, checking that they pick the same faces.
+
+    python -m benchmarks.select_boxes --batch-sizes 1 16 256
+"""
+
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.common import time_call
+from facenet_pytorch import MTCNN
+
+METHODS = ["probability", "largest", "largest_over_threshold", "center_weighted_size"]
+
+
+def loop_select_boxes(all_boxes, all_probs, all_points, imgs, method, threshold=0.9, center_weight=2.0):
+    """The per-image selection loop of select_boxes before it was vectorized, for batches."""
+    selected_boxes, selected_probs, selected_points = [], [], []
+    for boxes, points, probs, img in zip(all_boxes, all_points, all_probs, imgs):
+        if boxes is None:
+            selected_boxes.append(None)
+            selected_probs.append([None])
+            selected_points.append(None)
+            continue
+
+        boxes = np.array(boxes)
+        probs = np.array(probs)
+        points = np.array(points)
+
+        if method == "largest":
+            box_order = np.argsort((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))[::-1]
+        elif method == "probability":
+            box_order = np.argsort(probs)[::-1]
+        elif method == "center_weighted_size":
+            box_sizes = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            img_center = (img.width / 2, img.height / 2)
+            box_centers = np.array(list(zip((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2)))
+            offsets = box_centers - img_center
+            offset_dist_squared = np.sum(np.power(offsets, 2.0), 1)
+            box_order = np.argsort(box_sizes - offset_dist_squared * center_weight)[::-1]
+        elif method == "largest_over_threshold":
+            box_mask = probs > threshold
+            boxes = boxes[box_mask]
+            box_order = np.argsort((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))[::-1]
+            if sum(box_mask) == 0:
+                selected_boxes.append(None)
+                selected_probs.append([None])
+                selected_points.append(None)
+                continue
+
+        selected_boxes.append(boxes[box_order][[0]])
+        selected_probs.append(probs[box_order][[0]])
+        selected_points.append(points[box_order][[0]])
+    return selected_boxes, selected_probs, selected_points
+
+
+def synthetic_detections(batch_size, rng):
+    boxes, probs, points = [], [], []
+    for _ in range(batch_size):
+        n = rng.integers(0, 13)
+        if n == 0:
+            boxes.append(None)
+            probs.append([None])
+            points.append(None)
+            continue
+        xy = rng.uniform(0, 500, (n, 2))
+        boxes.append(np.concatenate([xy, xy + rng.uniform(20, 200, (n, 2))], 1).astype(np.float32))
+        probs.append(rng.uniform(0.7, 1.0, n).astype(np.float32))
+        points.append(rng.uniform(0, 700, (n, 5, 2)).astype(np.float32))
+    return (np.array(boxes, dtype=object), np.array(probs, dtype=object),
+            np.array(points, dtype=object))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="select_boxes benchmark.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    mtcnn = MTCNN()
+    rng = np.random.default_rng(0)
+    print(f"{'batch':>6} {'method':<24} {'loop ms':>8} {'vector ms':>10} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        detections = synthetic_detections(batch_size, rng)
+        imgs = [Image.new("RGB", (700, 600))] * batch_size
+        for method in METHODS:
+            ref = loop_select_boxes(*detections, imgs, method)
+            boxes, _, _ = mtcnn.select_boxes(*detections, imgs, method=method)
+            assert all((a is None and b is None) or np.array_equal(a, b) for a, b in zip(ref[0], boxes))
+
+            loop_ms = time_call(lambda: loop_select_boxes(*detections, imgs, method), repeat=args.repeat)
+            vector_ms = time_call(lambda: mtcnn.select_boxes(*detections, imgs, method=method),
+                                  repeat=args.repeat)
+            print(f"{batch_size:>6} {method:<24} {loop_ms:>8.3f} {vector_ms:>10.3f} "
+                  f"{loop_ms / vector_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Coarse-to-fine single-face detection against the full MTCNN pyramid on
+selfie-style uploads (the bundled one-face test images, at full size and
+at a phone-upload width).
+
+Reports median detection latency, pyramid levels run through PNet and
+the IoU between the largest face of both paths.
+
+    python -m benchmarks.single_face
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+
+from benchmarks.common import load_bgr, test_images, time_call
+from facenet_pytorch import MTCNN
+
+
+def iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-face early-exit benchmark.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[0, 720],
+                        help="resize uploads to these widths (0 = original size)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    full = MTCNN(select_largest=True)
+    fast = MTCNN(select_largest=True, single_face=True)
+
+    print(f"{'image':<16} {'size':>10} {'full ms':>8} {'fast ms':>8} {'speedup':>8} "
+          f"{'scales':>7} {'IoU':>5}")
+    speedups = []
+    for path in test_images():
+        rgb = cv2.cvtColor(load_bgr(path), cv2.COLOR_BGR2RGB)
+        for width in args.widths:
+            img = rgb if width == 0 else cv2.resize(rgb, (width, rgb.shape[0] * width // rgb.shape[1]))
+            full_stats, fast_stats = {}, {}
+            full_boxes, _ = full.detect(img, stats=full_stats)
+            fast_boxes, _ = fast.detect(img, stats=fast_stats)
+            overlap = iou(full_boxes[0], fast_boxes[0]) if full_boxes is not None and fast_boxes is not None else float("nan")
+
+            full_ms = time_call(lambda: full.detect(img), repeat=args.repeat, warmup=1)
+            fast_ms = time_call(lambda: fast.detect(img), repeat=args.repeat, warmup=1)
+            speedups.append(full_ms / fast_ms)
+            name = path.split("/")[-2][:16]
+            size = f"{img.shape[1]}x{img.shape[0]}"
+            scales = f"{full_stats['scales']}->{fast_stats['scales']}"
+            print(f"{name:<16} {size:>10} {full_ms:>8.0f} {fast_ms:>8.0f} {full_ms / fast_ms:>7.1f}x "
+                  f"{scales:>7} {overlap:>5.2f}")
+
+    print(f"\nmedian speedup: {np.median(speedups):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
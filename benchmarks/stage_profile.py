@@ -0,0 +1,50 @@
+"""
+Where FaceProcessor.get_template spends its time: pyramid building, PNet,
+NMS, RNet/ONet crops and nets, alignment and embedding, from the spans of
+facenet_pytorch.models.utils.profiling, plus the candidate boxes
+surviving each stage. Also times get_template with profiling off and on,
+to check the instrumentation overhead.
+
+    python -m benchmarks.stage_profile --widths 0 640
+"""
+
+import argparse
+
+from benchmarks.common import load_bgr, test_images, time_call
+from benchmarks.matrix import resize_width
+from api_server import FROZEN_MODELS
+from face_processor import FaceProcessor
+from facenet_pytorch import profiling
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage get_template profile.")
+    parser.add_argument("--widths", type=int, nargs="+", default=[0, 640],
+                        help="resize the test images to these widths (0 = original size)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--all-faces", action="store_true",
+                        help="search the whole pyramid (single_face=False)")
+    args = parser.parse_args()
+
+    processor = FaceProcessor(frozen=FROZEN_MODELS, single_face=not args.all_faces)
+    images = [load_bgr(path) for path in test_images()]
+    for width in args.widths:
+        frames = [resize_width(img, width) if width else img for img in images]
+        run = lambda: [processor.get_template(frame) for frame in frames]
+        off_ms = time_call(run, repeat=args.repeat, warmup=1) / len(frames)
+
+        def profiled():
+            with profiling.profile():
+                run()
+
+        on_ms = time_call(profiled, repeat=args.repeat, warmup=0) / len(frames)
+        with profiling.profile() as prof:
+            run()
+
+        print(f"\n--- width {width or 'original'}: {len(frames)} images, "
+              f"{off_ms:.1f} ms/image unprofiled, {on_ms:.1f} ms/image profiled ---")
+        print(prof.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Memory-bounded tiled detection against whole-image detection on large
+group photos (multiface.jpg upscaled to a few megapixel counts).
+
+Every (size, mode) pair runs in a fresh interpreter so peak RSS is not
+shared between runs. Reports the peak RSS added by detection (after the
+models and the decoded image are loaded), latency and the number of
+faces found.
+
+    python -m benchmarks.tiled_detection --megapixels 12 24 --budgets 128 256
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.common import FACENET_DATA, load_bgr
+
+
+def worker(megapixels, budget):
+    from facenet_pytorch import MTCNN
+
+    image = cv2.cvtColor(load_bgr(os.path.join(FACENET_DATA, "multiface.jpg")), cv2.COLOR_BGR2RGB)
+    scale = np.sqrt(megapixels * 1e6 / (image.shape[0] * image.shape[1]))
+    img = cv2.resize(image, (int(image.shape[1] * scale), int(image.shape[0] * scale)))
+
+    mtcnn = MTCNN(keep_all=True, max_memory_mb=budget)
+    mtcnn.detect(img[:200, :200])
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    boxes, _ = mtcnn.detect(img)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "peak_mb": (peak - base) / 1024, "seconds": seconds,
+        "faces": 0 if boxes is None else len(boxes),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiled detection memory benchmark.")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[12, 24])
+    parser.add_argument("--budgets", type=float, nargs="+", default=[128, 256],
+                        help="max_memory_mb values to compare against whole-image detection")
+    parser.add_argument("--worker", nargs=2, type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        megapixels, budget = args.worker
+        worker(megapixels, None if budget == 0 else budget)
+        return
+
+    print(f"{'MP':>5} {'mode':>10} {'peak MB':>8} {'seconds':>8} {'faces':>6}")
+    for megapixels in args.megapixels:
+        for budget in [0] + args.budgets:
+            proc = subprocess.run(
+                [sys.executable, "-m", "benchmarks.tiled_detection", "--worker",
+                 str(megapixels), str(budget)],
+                capture_output=True, text=True
+            )
+            if proc.returncode != 0:
+                print(f"{megapixels:>5.0f} {budget:>10.0f} failed: {proc.stderr.strip()[-300:]}")
+                continue
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            mode = "whole" if budget == 0 else f"{budget:.0f} MB"
+            print(f"{megapixels:>5.0f} {mode:>10} {result['peak_mb']:>8.0f} "
+                  f"{result['seconds']:>8.1f} {result['faces']:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+compile_models.py
+-----------------
+Freeze MobileFaceNet and the MTCNN P-, R- and O-nets into TorchScript
+artifacts keyed by a hash of their weights, the torch version and their
+model code (models/MobileFaceNet.py, the PNet/RNet/ONet classes in
+facenet_pytorch/models/mtcnn.py), so FaceProcessor (and the Android
+engine) can load them directly at start-up. Editing either the weights
+or that code makes the next load rebuild the artifact.
+
+MobileFaceNet is built from FR_WEIGHTS (MFN_AdaArcDistill_backbone.pth in
+the repository root), which is not distributed with the repository; see
+"Model weights" in README.md.
+
+Artifacts are written to $FACENET_FROZEN_HOME (default: <TORCH_HOME>/frozen).
+FaceProcessor rebuilds stale artifacts on its own; running this ahead of
+time just moves the one-off compile cost out of the first server start.
+
+With --onnx the same models are exported to ONNX instead (PNet with
+dynamic spatial axes) for FaceProcessor(backend='onnx'); every fresh
+export is checked for parity against the PyTorch outputs.
+
+Run with:
+    python compile_models.py            # build missing / stale artifacts
+    python compile_models.py --force    # rebuild everything
+    python compile_models.py --onnx     # export ONNX models
+"""
+
+import argparse
+import os
+import time
+
+from face_processor import load_fr_model
+from facenet_pytorch.models.mtcnn import load_frozen_nets, load_onnx_nets
+from facenet_pytorch.models.utils.freeze import get_frozen_home
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Freeze FaceProcessor models into TorchScript artifacts.")
+    parser.add_argument("--force", action="store_true", help="rebuild even if up to date")
+    parser.add_argument("--onnx", action="store_true", help="export ONNX models instead")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.onnx:
+        load_onnx_nets(rebuild=args.force)
+        load_fr_model(backend="onnx", rebuild=args.force)
+        kind, location = "ONNX exports", os.path.join(get_frozen_home(), "onnx")
+    else:
+        load_frozen_nets(rebuild=args.force)
+        load_fr_model(frozen=True, rebuild=args.force)
+        kind, location = "Frozen artifacts", get_frozen_home()
+    elapsed = time.perf_counter() - start
+    print(f"{kind} ready in {location} ({elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,47 @@
+import inspect
+import json
+import os
+import sys
+import time
 import torch
 import numpy as np
 import cv2
-from facenet_pytorch import MTCNN
+
+# Use the facenet_pytorch vendored with the Android engine so the server and the
+# app share one detector implementation (and its frozen-model cache).
+PYENGINE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "MyfaceApp", "android", "pyengine", "src", "main", "python"
+)
+if PYENGINE_DIR not in sys.path:
+    sys.path.insert(0, PYENGINE_DIR)
+
+from facenet_pytorch import MTCNN, FaceTracker
+from facenet_pytorch.models.utils.detect_face import get_model_dtype
+from facenet_pytorch.models.utils.freeze import load_frozen
+from facenet_pytorch.models.utils.onnx_backend import load_onnx
+from facenet_pytorch.models.utils.quantize import load_quantized
+from facenet_pytorch.models.utils.precision import frozen_name, mark_input_dtype, precision_dtype
+from facenet_pytorch.models.utils.profiling import span
+from facenet_pytorch.models.utils import registry
 from models.MobileFaceNet import MobileFaceNet
 
+# MobileFaceNet (AdaArcDistill) backbone weights. Not distributed with the
+# repository: place the checkpoint here (see README, "Model weights").
+FR_WEIGHTS = "MFN_AdaArcDistill_backbone.pth"
+# code the frozen / ONNX MobileFaceNet is built from (part of the artifact cache key)
+FR_SOURCES = [inspect.getmodule(MobileFaceNet)]
+FR_INT8_WEIGHTS = "MFN_AdaArcDistill_backbone.int8.pt"   # written by quantize_model.py
+RUNTIME_PROFILE = "runtime_profile.json"                  # written by autotune.py
+# FaceProcessor arguments that autotune.py tunes per host, plus the model
+# and detection options it tuned them with
+PROFILE_SETTINGS = ("num_threads", "batch_size", "factor", "detect_resolution", "frozen",
+                    "single_face")
+# (height, width) of the camera frames warmup() runs detection at: VGA, HD and
+# Full HD landscape, and a portrait phone frame
+WARMUP_RESOLUTIONS = ((480, 640), (720, 1280), (1080, 1920), (640, 480))
+WARMUP_CANDIDATES = (1, 32)     # RNet/ONet batch sizes warmed (boxes surviving PNet/RNet)
+
 # --- 1. Alignment function (from the professor's reference) ---
 def align_face(img, landmarks):
     """
@@ -18,9 +56,108 @@ def align_face(img, landmarks):
     tform = cv2.estimateAffinePartial2D(landmarks, M, method=cv2.LMEDS)[0]
     return cv2.warpAffine(img, tform, (112, 112))
 
+def to_face_tensor(aligned_face_rgb):
+    """Normalised 1x3x112x112 model input from an aligned 112x112 RGB face."""
+    face_tensor = torch.from_numpy(aligned_face_rgb.transpose((2, 0, 1))).float()
+    face_tensor = (face_tensor - 127.5) / 128.0
+    return face_tensor.unsqueeze(0)
+
+def build_fr_model(device='cpu'):
+    """Eager MobileFaceNet with the AdaArcDistill weights loaded."""
+    fr_model = MobileFaceNet(512).to(device)
+    fr_model.load_state_dict(torch.load(FR_WEIGHTS, map_location=device), strict=False)
+    return fr_model.eval()
+
+def load_fr_model(device='cpu', frozen=True, rebuild=False, backend='torch', onnx_options=None,
+                  precision='fp32'):
+    """MobileFaceNet as a frozen TorchScript artifact (built on a cache miss), eager,
+    or as an ONNX Runtime session (exported on a cache miss) when backend='onnx'.
+    precision ('fp32', 'bf16' or 'fp16') casts the torch models; reduced-precision
+    frozen models are compiled to their own artifact."""
+    dtype = precision_dtype(precision)
+    if not os.path.isfile(FR_WEIGHTS):
+        raise FileNotFoundError(
+            f"MobileFaceNet weights not found at {os.path.abspath(FR_WEIGHTS)!r}; "
+            "see 'Model weights' in README.md"
+        )
+    if backend == 'onnx':
+        return load_onnx(
+            "mobilefacenet", build_fr_model, torch.rand(2, 3, 112, 112),
+            [FR_WEIGHTS], ["embedding"], rebuild=rebuild, sources=FR_SOURCES,
+            **(onnx_options or {})
+        )
+    if not frozen:
+        return build_fr_model(device).to(dtype)
+    fr_model = load_frozen(
+        frozen_name("mobilefacenet", precision), lambda: build_fr_model().to(dtype),
+        torch.zeros(1, 3, 112, 112, dtype=dtype), [FR_WEIGHTS], device=device, rebuild=rebuild,
+        sources=FR_SOURCES
+    )
+    return mark_input_dtype(fr_model, precision)
+
+def load_profile(path=RUNTIME_PROFILE):
+    """
+    The tuned FaceProcessor settings (PROFILE_SETTINGS) from a profile
+    written by autotune.py, or {} if there is no profile at path.
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        profile = json.load(f)
+    tuned_cpus = profile.get("host", {}).get("cpu_count")
+    if tuned_cpus is not None and tuned_cpus != os.cpu_count():
+        print(f"--- {path} was tuned on a host with {tuned_cpus} CPUs, "
+              f"this one has {os.cpu_count()}; rerun autotune.py ---")
+    return {k: v for k, v in profile.get("config", {}).items() if k in PROFILE_SETTINGS}
+
 # --- 2. The main processing class ---
 class FaceProcessor:
-    def __init__(self):
+    def __init__(self, frozen=False, quantized=False, backend='torch', onnx_options=None,
+                 preset=None, max_face_size=None, face_size_range=None, single_face=False,
+                 max_memory_mb=None, precision='fp32', factor=0.709, num_threads=None,
+                 batch_size=None, detect_resolution=None):
+        """
+        frozen: load MobileFaceNet and the MTCNN nets from frozen TorchScript
+        artifacts keyed by weight hash (compiled on first start and whenever
+        the weights change) instead of building them from Python. Off by
+        default; api_server.py turns it on (FROZEN_MODELS).
+        quantized: use the int8 MobileFaceNet produced by quantize_model.py
+        in place of the fp32 model. Quantized kernels run on the CPU only.
+        backend: 'torch' or 'onnx' to run the detector and embedder in ONNX
+        Runtime CPU sessions; onnx_options sets intra_op_num_threads,
+        inter_op_num_threads and graph_optimization_level.
+        preset: MTCNN detection preset ('selfie', 'enrollment', 'turnstile'
+        or 'crowd'); max_face_size (pixels) and face_size_range (fractions
+        of the image's short side) bound the detection pyramid instead.
+        single_face: only the largest face is used, so search the pyramid
+        from the largest faces down and stop once it is found. Off by
+        default; api_server.py turns it on (SINGLE_FACE).
+        max_memory_mb: peak detection memory budget per image; larger images
+        are detected in tiles (single_face only applies below the budget).
+        precision: 'fp32', 'bf16' or 'fp16' to run MobileFaceNet and the MTCNN
+        nets in that dtype. Box regression, NMS and the returned templates
+        stay float32; check agreement with precision_report.py first. Not
+        available with quantized=True or backend='onnx'.
+        factor: MTCNN pyramid scale factor; smaller runs fewer pyramid
+        levels but can miss faces between levels.
+        num_threads: torch.set_num_threads for the whole process (None
+        keeps torch's default).
+        batch_size: images per detector and MobileFaceNet call in
+        get_templates (None: all images at once).
+        detect_resolution: longest image side, in pixels, that detection
+        runs at. Larger images are downscaled for MTCNN only; faces are
+        still aligned from the full image.
+        autotune.py measures factor, num_threads, batch_size and
+        detect_resolution on the host; from_profile() applies its result.
+        """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.batch_size = batch_size
+        self.detect_resolution = detect_resolution
+        self.fr_dtype = precision_dtype(precision)
+        if precision != 'fp32' and (quantized or backend == 'onnx'):
+            raise ValueError("precision must be 'fp32' with quantized=True or backend='onnx'")
+        self.precision = precision
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         print(f"--- Initializing models on device: {self.device} ---")
         
@@ -30,27 +167,138 @@ class FaceProcessor:
             margin=0, 
             min_face_size=20,
             thresholds=[0.6, 0.7, 0.7], 
-            factor=0.709, 
+            factor=factor,
             post_process=True,
             device=self.device,
-            select_largest=True # Focus on the most prominent face
+            select_largest=True, # Focus on the most prominent face
+            frozen=frozen,
+            backend=backend,
+            onnx_options=onnx_options,
+            max_face_size=max_face_size,
+            face_size_range=face_size_range,
+            preset=preset,
+            single_face=single_face,
+            max_memory_mb=max_memory_mb,
+            precision=precision
         )
 
-        # Load MobileFaceNet for template extraction
-        self.fr_model = MobileFaceNet(512).to(self.device)
-        self.fr_model.load_state_dict(torch.load("MFN_AdaArcDistill_backbone.pth", map_location=self.device), strict=False)
-        self.fr_model.eval()
+        # Load MobileFaceNet for template extraction (shared through the model registry)
+        if quantized:
+            self.fr_device = 'cpu'
+            self.fr_model = registry.get_model(
+                "mobilefacenet", lambda: load_quantized(FR_INT8_WEIGHTS),
+                weights=os.path.abspath(FR_INT8_WEIGHTS), precision="int8", backend="frozen"
+            )
+        elif backend == 'onnx':
+            self.fr_device = 'cpu'
+            self.fr_model = registry.get_model(
+                "mobilefacenet", lambda: load_fr_model(backend='onnx', onnx_options=onnx_options),
+                weights=os.path.abspath(FR_WEIGHTS), backend="onnx", options=onnx_options
+            )
+        else:
+            self.fr_device = self.device
+            self.fr_model = registry.get_model(
+                "mobilefacenet",
+                lambda: load_fr_model(self.device, frozen=frozen, precision=precision),
+                weights=os.path.abspath(FR_WEIGHTS), device=self.device, precision=precision,
+                backend="frozen" if frozen else "torch"
+            )
         print("--- All models initialized successfully ---")
 
-    def get_template(self, image_bgr):
+    @classmethod
+    def from_profile(cls, path=RUNTIME_PROFILE, **options):
         """
-        Takes a BGR image (from cv2), detects, aligns, and extracts a face template.
+        FaceProcessor with the settings autotune.py chose for this host
+        (see load_profile), or the defaults if there is no profile.
+        options are passed to __init__ and take precedence over the profile.
+        """
+        settings = load_profile(path)
+        if settings:
+            print(f"--- Runtime profile {path}: {settings} ---")
+        settings.update(options)
+        return cls(**settings)
+
+    def warmup(self, resolutions=WARMUP_RESOLUTIONS, repeat=2):
+        """
+        Run synthetic inputs through every network so that the first real
+        request does not pay for lazy allocations, oneDNN kernel selection
+        and first-touch page faults: MTCNN.detect on a noise image at each
+        camera resolution (through detect_resolution, as get_template does,
+        and as a batch of batch_size frames at the first one), RNet and ONet
+        at WARMUP_CANDIDATES boxes, and MobileFaceNet at batch 1 and
+        batch_size. Each step runs `repeat` times. Returns the milliseconds
+        spent per step.
+        """
+        rng = np.random.default_rng(0)
+        timings = {}
+
+        def run(name, fn):
+            start = time.perf_counter()
+            with torch.no_grad():
+                for _ in range(repeat):
+                    fn()
+            timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+        frames = []
+        for h, w in resolutions:
+            image_rgb = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+            frame, _ = self._detection_image(image_rgb)
+            frames.append(frame)
+            run(f"detect/{h}x{w}", lambda: self.mtcnn.detect(frame, landmarks=True))
+        if frames and self.batch_size is not None and self.batch_size > 1:
+            batch = [frames[0]] * self.batch_size
+            run(f"detect/batch={self.batch_size}", lambda: self.mtcnn.detect(batch, landmarks=True))
+
+        for name, net, size in (("rnet", self.mtcnn.rnet, 24), ("onet", self.mtcnn.onet, 48)):
+            dtype = get_model_dtype(net)
+            for n in WARMUP_CANDIDATES:
+                crops = torch.zeros(n, 3, size, size, device=self.device, dtype=dtype)
+                run(f"{name}/n={n}", lambda: net(crops))
+
+        for n in sorted({1, self.batch_size or 1}):
+            faces = torch.zeros(n, 3, 112, 112, device=self.fr_device, dtype=self.fr_dtype)
+            run(f"embed/n={n}", lambda: self.fr_model(faces))
+        return timings
+
+    def _detection_image(self, image_rgb):
+        """
+        image_rgb downscaled so its longest side is at most
+        detect_resolution, and the scale applied.
+        """
+        h, w = image_rgb.shape[:2]
+        if self.detect_resolution is None or max(h, w) <= self.detect_resolution:
+            return image_rgb, 1.0
+        scale = self.detect_resolution / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        with span("resize"):
+            return cv2.resize(image_rgb, size, interpolation=cv2.INTER_AREA), scale
+
+    def tracker(self, **options):
+        """
+        A FaceTracker over this processor's detector, for camera streams:
+        pass it to get_aligned_face/get_template with every frame and only
+        the area around the previous face is searched between periodic full
+        detections. options: redetect_every, min_prob, search_margin,
+        size_range.
+        """
+        return FaceTracker(self.mtcnn, **options)
+
+    def get_aligned_face(self, image_bgr, stats=None, tracker=None):
+        """
+        Takes a BGR image (from cv2), detects and aligns the most prominent face.
+        Returns the normalised 1x3x112x112 face tensor and its bounding box,
+        or (None, None) if no face is found. If a stats dict is given it is
+        filled with the detector's work (pyramid scales and PNet pixels).
+        tracker: a FaceTracker from self.tracker() when image_bgr is the next
+        frame of a video stream.
         """
         # MTCNN expects an RGB image
         image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
         
-        # Detect face and landmarks
-        boxes, _, landmarks = self.mtcnn.detect(image_rgb, landmarks=True)
+        # Detect face and landmarks (at detect_resolution)
+        detector = self.mtcnn if tracker is None else tracker
+        detection_rgb, scale = self._detection_image(image_rgb)
+        boxes, _, landmarks = detector.detect(detection_rgb, landmarks=True, stats=stats)
         
         # If no face is detected, return None
         if landmarks is None:
@@ -61,20 +309,84 @@ class FaceProcessor:
         face_landmarks = landmarks[0]
         
         # *** THIS IS THE FIX: Convert landmarks to the correct data type for OpenCV ***
-        face_landmarks_np = np.array(face_landmarks, dtype=np.float32)
+        face_landmarks_np = np.array(face_landmarks, dtype=np.float32) / scale
 
         # Align the face using the provided function
-        aligned_face_rgb = align_face(image_rgb, face_landmarks_np)
+        with span("align"):
+            aligned_face_rgb = align_face(image_rgb, face_landmarks_np)
         
-        # Convert the aligned face to a tensor for the model
-        face_tensor = torch.from_numpy(aligned_face_rgb.transpose((2, 0, 1))).float()
-        face_tensor = (face_tensor - 127.5) / 128.0
-        face_tensor = face_tensor.unsqueeze(0).to(self.device)
-        
-        # Extract the template (feature vector)
-        with torch.no_grad():
-            feature_vector = self.fr_model(face_tensor)
-            
+            # Convert the aligned face to a tensor for the model
+            face_tensor = to_face_tensor(aligned_face_rgb)
+        return face_tensor, boxes[0] / scale
+
+    def get_template(self, image_bgr, stats=None, tracker=None):
+        """
+        Takes a BGR image (from cv2), detects, aligns, and extracts a face template.
+        stats, tracker: see get_aligned_face. Inside a profiling.profile()
+        context the detection stages, alignment and embedding are timed.
+        """
+        with span("get_template"):
+            return self._get_template(image_bgr, stats, tracker)
+
+    def _get_template(self, image_bgr, stats, tracker):
+        face_tensor, bbox = self.get_aligned_face(image_bgr, stats=stats, tracker=tracker)
+        if face_tensor is None:
+            return None, None
+
         # Return the template and the bounding box for drawing
-        bbox = boxes[0] 
-        return feature_vector.cpu().numpy(), bbox
+        return self.embed(face_tensor), bbox
+
+    def embed(self, face_tensor):
+        """
+        Template (1x512 numpy array) of a face tensor from get_aligned_face,
+        e.g. to embed a face already located without detecting it again.
+        """
+        with span("embed"), torch.no_grad():
+            feature_vector = self.fr_model(face_tensor.to(self.fr_device, self.fr_dtype)).float()
+        return feature_vector.cpu().numpy()
+
+    def get_templates(self, images_bgr, stats=None):
+        """
+        get_template for a list of BGR images, which may have different
+        sizes: one detector call over all images (mixed sizes are bucketed
+        and padded into shared batches) and one MobileFaceNet pass over all
+        the faces found, or one of each per batch_size images. Returns a
+        (template, bbox) pair per image, in order, with (None, None) where
+        no face was found.
+        """
+        if not images_bgr:
+            return []
+        if self.batch_size is None or len(images_bgr) <= self.batch_size:
+            return self._get_templates(images_bgr, stats)
+        results = []
+        for start in range(0, len(images_bgr), self.batch_size):
+            batch_stats = {}
+            batch = images_bgr[start:start + self.batch_size]
+            results.extend(self._get_templates(batch, batch_stats))
+            if stats is not None:
+                for key in ("scales", "pnet_pixels"):
+                    stats[key] = stats.get(key, 0) + batch_stats.get(key, 0)
+        return results
+
+    def _get_templates(self, images_bgr, stats):
+        images_rgb = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images_bgr]
+        detection_rgb, scales = zip(*[self._detection_image(image) for image in images_rgb])
+        boxes, _, landmarks = self.mtcnn.detect(list(detection_rgb), landmarks=True, stats=stats)
+
+        faces, found = [], []
+        with span("align"):
+            for i, (image_rgb, face_landmarks) in enumerate(zip(images_rgb, landmarks)):
+                if face_landmarks is None:
+                    continue
+                face_landmarks_np = np.array(face_landmarks[0], dtype=np.float32) / scales[i]
+                faces.append(to_face_tensor(align_face(image_rgb, face_landmarks_np)))
+                found.append(i)
+
+        results = [(None, None)] * len(images_bgr)
+        if faces:
+            with span("embed"), torch.no_grad():
+                face_batch = torch.cat(faces).to(self.fr_device, self.fr_dtype)
+                feature_vectors = self.fr_model(face_batch).float().cpu().numpy()
+            for i, feature_vector in zip(found, feature_vectors):
+                results[i] = (feature_vector[None], boxes[i][0] / scales[i])
+        return results
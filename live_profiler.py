@@ -0,0 +1,251 @@
+"""
+live_profiler.py
+----------------
+On-demand profiling of live traffic for api_server.py's /debug/profile.
+
+A session runs for a fixed number of seconds. Requests handled by views
+wrapped with `live.profiled` during the session run under cProfile,
+torch.profiler and the facenet_pytorch stage spans; their results are
+merged into one report of hot Python functions, torch operators and
+detection stages, plus a Chrome trace (chrome://tracing or Perfetto).
+No thread waits for a session: start() returns at once, and a session
+is finished (trace written, report built) by the first report() call
+after it ends, or by the next start(). Each process profiles only its
+own traffic, so with several worker processes a session covers the
+worker that received the start call.
+
+Overhead is bounded:
+* one session at a time (start() returns None while one is running);
+* at most one request is instrumented at a time -- cProfile and
+  torch.profiler only see the thread that starts them, and torch allows
+  a single active profiler -- so concurrent requests pass through
+  unprofiled and are only counted;
+* at most `max_requests` requests per session;
+* no shapes, stacks or memory are recorded by torch.profiler;
+* trace events are appended to a spool file on disk as each request
+  finishes (at most `max_request_events` per request and
+  `max_trace_events` per session; the rest are counted as dropped), so
+  memory only holds the function, operator and stage summaries.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+
+class ProfileSession:
+    """Results collected by one /debug/profile call."""
+
+    def __init__(self, seconds, max_requests):
+        self.seconds = seconds
+        self.max_requests = max_requests
+        self.deadline = time.monotonic() + seconds
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.requests = 0            # requests profiled
+        self.skipped = 0             # requests that ran while another was profiled
+        self.stats = None            # merged pstats.Stats
+        self.ops = {}                # torch op -> [calls, self cpu us, total cpu us]
+        self.stages = None           # facenet_pytorch.profiling.Profile with every span
+        self.trace_events = 0        # events written to the spool file
+        self.dropped_events = 0      # events over the per-request or per-session cap
+        self.finished = False        # trace written, no more requests recorded
+
+    def active(self):
+        return (not self.finished and time.monotonic() < self.deadline
+                and self.requests < self.max_requests)
+
+    def remaining(self):
+        """Seconds until the session ends (it may end earlier, after max_requests)."""
+        return max(0.0, self.deadline - time.monotonic())
+
+
+class LiveProfiler:
+    """
+    Profiles the requests of wrapped views while a session is running.
+
+    Keyword Arguments:
+        trace_path -- where a finished session's merged Chrome trace is
+            written; events are spooled to trace_path + ".events" meanwhile.
+        max_requests -- profiled requests per session.
+        max_request_events -- trace events kept per profiled request.
+        max_trace_events -- trace events kept per session.
+    """
+
+    def __init__(self, trace_path="profile_trace.json", max_requests=50,
+                 max_request_events=20000, max_trace_events=200000):
+        self.trace_path = trace_path
+        self.spool_path = trace_path + ".events"
+        self.max_requests = max_requests
+        self.max_request_events = max_request_events
+        self.max_trace_events = max_trace_events
+        self._session = None                      # the running or last session
+        self._lock = threading.Lock()             # guards starting and finishing sessions
+        self._request_lock = threading.Lock()     # held by the request being profiled
+
+    def start(self, seconds):
+        """Begin a session, or return None if one is already running."""
+        with self._lock:
+            if self._session is not None and self._session.active():
+                return None
+            if self._session is not None:
+                self._finish(self._session)
+            open(self.spool_path, "w").close()
+            self._session = ProfileSession(seconds, self.max_requests)
+            return self._session
+
+    def report(self, top=30):
+        """
+        None if no session was started; {"running": True, ...} while the
+        session runs; otherwise the report of the last session (finishing
+        it first if needed).
+        """
+        with self._lock:
+            session = self._session
+            if session is None:
+                return None
+            if session.active():
+                return {"running": True, "started": session.started,
+                        "remaining_seconds": round(session.remaining(), 1),
+                        "requests": session.requests}
+            self._finish(session)
+            return self._report(session, top)
+
+    def _finish(self, session):
+        if session.finished:
+            return
+        with self._request_lock:                  # wait for the request being profiled
+            session.finished = True
+        self._write_trace()
+
+    def profiled(self, view):
+        """Decorator for Flask views whose requests a session may profile."""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            session = self._session
+            if session is None or not session.active():
+                return view(*args, **kwargs)
+            if not self._request_lock.acquire(blocking=False):
+                with self._lock:
+                    session.skipped += 1
+                return view(*args, **kwargs)
+            try:
+                if not session.active():
+                    return view(*args, **kwargs)
+                return self._run(session, view, args, kwargs)
+            finally:
+                self._request_lock.release()
+        return wrapper
+
+    def _run(self, session, view, args, kwargs):
+        # imported here so that importing api_server stays cheap;
+        # face_processor puts the vendored facenet_pytorch on sys.path
+        import face_processor  # noqa: F401
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+        from facenet_pytorch import profiling
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        python_prof = cProfile.Profile()
+        with profile(activities=activities) as torch_prof, profiling.profile() as stages:
+            python_prof.enable()
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                python_prof.disable()
+        session.requests += 1
+        self._merge_python(session, python_prof)
+        self._merge_stages(session, stages)
+        self._merge_torch(session, torch_prof)
+        return response
+
+    @staticmethod
+    def _merge_python(session, python_prof):
+        if session.stats is None:
+            session.stats = pstats.Stats(python_prof)
+        else:
+            session.stats.add(python_prof)
+
+    @staticmethod
+    def _merge_stages(session, stages):
+        if session.stages is None:
+            session.stages = type(stages)()
+        session.stages.spans.extend(stages.spans)
+        for name, value in stages.counters.items():
+            session.stages.count(name, value)
+
+    def _merge_torch(self, session, torch_prof):
+        for evt in torch_prof.key_averages():
+            op = session.ops.setdefault(evt.key, [0, 0.0, 0.0])
+            op[0] += evt.count
+            op[1] += evt.self_cpu_time_total
+            op[2] += evt.cpu_time_total
+        # export_chrome_trace only writes to a file; its events are appended to the
+        # spool (one JSON event per line) and dropped from memory with this request
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            torch_prof.export_chrome_trace(path)
+            with open(path) as f:
+                events = json.load(f).get("traceEvents", [])
+        finally:
+            os.remove(path)
+        room = min(self.max_request_events, self.max_trace_events - session.trace_events)
+        kept = events[:max(0, room)]
+        session.dropped_events += len(events) - len(kept)
+        with open(self.spool_path, "a") as spool:
+            for event in kept:
+                spool.write(json.dumps(event) + "\n")
+        session.trace_events += len(kept)
+
+    def _write_trace(self):
+        """Stream the spooled events into a Chrome trace at trace_path."""
+        with open(self.trace_path, "w") as out:
+            out.write('{"traceEvents": [\n')
+            if os.path.exists(self.spool_path):
+                with open(self.spool_path) as spool:
+                    for i, line in enumerate(spool):
+                        out.write((",\n" if i else "") + line.rstrip("\n"))
+                os.remove(self.spool_path)
+            out.write("\n]}\n")
+
+    @staticmethod
+    def _report(session, top):
+        functions = []
+        if session.stats is not None:
+            rows = session.stats.stats.items()
+            # (file, line, name) -> (primitive calls, calls, own time, cumulative time, callers)
+            for (file, line, name), (_, calls, own, cumulative, _) in sorted(
+                rows, key=lambda row: row[1][3], reverse=True
+            )[:top]:
+                functions.append({
+                    "function": f"{os.path.basename(file)}:{line}({name})",
+                    "calls": calls,
+                    "own_ms": round(own * 1000, 3),
+                    "cumulative_ms": round(cumulative * 1000, 3),
+                })
+        operators = [
+            {"name": name, "calls": calls,
+             "self_cpu_ms": round(self_us / 1000, 3), "cpu_ms": round(total_us / 1000, 3)}
+            for name, (calls, self_us, total_us) in sorted(
+                session.ops.items(), key=lambda op: op[1][1], reverse=True
+            )[:top]
+        ]
+        return {
+            "running": False,
+            "started": session.started,
+            "seconds": session.seconds,
+            "requests": session.requests,
+            "skipped_requests": session.skipped,
+            "trace_events": session.trace_events,
+            "dropped_trace_events": session.dropped_events,
+            "functions": functions,
+            "operators": operators,
+            "stages": session.stages.as_dict() if session.stages is not None else {},
+        }
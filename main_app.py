@@ -5,7 +5,9 @@ import time
 
 def run_the_app():
     # --- 1. INITIALIZATION ---
-    processor = FaceProcessor()
+    processor = FaceProcessor.from_profile()
+    # Between periodic full detections, only search around the last face seen
+    tracker = processor.tracker()
     print("--- All models initialized successfully. ---")
     
     # This will hold our "database" in memory
@@ -43,7 +45,7 @@ def run_the_app():
         # Try to get a template every second
         if int(time.time()) % 2 == 0:
             try:
-                template, _ = processor.get_template(frame)
+                template, _ = processor.get_template(frame, tracker=tracker)
                 if template is not None:
                     enrolled_template = template
                     print("\n--- FACE CAPTURED SUCCESSFULLY! ---")
@@ -69,11 +71,19 @@ def run_the_app():
     print("Press [q] to quit.")
     print("="*50)
 
+    tracker.reset()
     while True:
         ret, frame = cap.read()
         if not ret: break
 
-        cv2.imshow("Verification - Press [SPACE] to test", frame)
+        # Follow the face from frame to frame so it can be shown before testing;
+        # SPACE embeds the face aligned here rather than detecting the frame again
+        face_tensor, bbox = processor.get_aligned_face(frame, tracker=tracker)
+        display = frame.copy()
+        if bbox is not None:
+            x1, y1, x2, y2 = [int(v) for v in bbox]
+            cv2.rectangle(display, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.imshow("Verification - Press [SPACE] to test", display)
         key = cv2.waitKey(1) & 0xFF
 
         if key == ord('q'):
@@ -82,7 +92,7 @@ def run_the_app():
         if key == ord(' '):
             print("\nVerifying...")
             try:
-                live_template, _ = processor.get_template(frame)
+                live_template = None if face_tensor is None else processor.embed(face_tensor)
                 if live_template is not None:
                     score = cosine_similarity(enrolled_template, live_template)[0][0]
                     
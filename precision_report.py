@@ -0,0 +1,150 @@
+"""
+precision_report.py
+-------------------
+Parity of reduced-precision (bf16/fp16) execution against fp32.
+
+1. Detector: MTCNN runs in each precision over the images in --image-dir.
+   Every fp32 face is matched to the reduced-precision face with the
+   highest box IoU, and the report gives the IoU (mean/min), the
+   number of images whose face count changed and the detection latency.
+2. Embedder: MobileFaceNet embeds the fp32-aligned crops of those images
+   in each precision, and the embeddings are compared with fp32:
+   * cosine agreement between each embedding and its fp32 counterpart
+   * verification decision agreement at THRESHOLD over every crop pair
+
+Both stages keep box regression, NMS and the embedding normalisation in
+float32, as FaceProcessor(precision=...) does. Use the report to pick
+the precision for FaceProcessor(precision=...) on the server or
+FACEAUTH_PRECISION in the Android engine (--model android).
+
+Run with:
+    python precision_report.py [--image-dir path/to/faces] [--precisions bf16 fp16]
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from api_server import THRESHOLD
+from face_processor import FaceProcessor, build_fr_model
+from facenet_pytorch import MTCNN
+from facenet_pytorch.models.utils.precision import precision_dtype
+from quantize_model import (
+    DEFAULT_FACES, agreement_report, aligned_crops, build_android_model, embed, image_paths,
+    latency_ms
+)
+
+
+def load_images(image_dir):
+    """RGB images under image_dir, as MTCNN sees them in FaceProcessor."""
+    paths = [
+        p for ext in ("jpg", "jpeg", "png")
+        for p in glob.glob(os.path.join(image_dir, "**", f"*.{ext}"), recursive=True)
+    ]
+    images = []
+    for path in sorted(paths):
+        img = cv2.imread(path)
+        if img is not None:
+            images.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    if not images:
+        raise RuntimeError(f"No images found under {image_dir}")
+    return images
+
+
+def box_iou(a, b):
+    """Pairwise IoU of two Nx4 and Mx4 box arrays."""
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def detect_all(mtcnn, images):
+    """Boxes per image (Nx4, possibly empty) and the total detection time in ms."""
+    boxes = []
+    start = time.perf_counter()
+    for img in images:
+        found, _ = mtcnn.detect(img)
+        boxes.append(np.zeros((0, 4)) if found is None else np.asarray(found, dtype=np.float64))
+    return boxes, (time.perf_counter() - start) * 1000
+
+
+def detector_report(images, precision):
+    # warm up both detectors on the first image so lazy loading is not timed
+    fp32, reduced = MTCNN(), MTCNN(precision=precision)
+    fp32.detect(images[0])
+    reduced.detect(images[0])
+    fp32_boxes, fp32_ms = detect_all(fp32, images)
+    boxes, ms = detect_all(reduced, images)
+
+    ious, count_mismatches = [], 0
+    for ref, found in zip(fp32_boxes, boxes):
+        count_mismatches += len(ref) != len(found)
+        if len(ref) == 0:
+            continue
+        best = box_iou(ref, found).max(axis=1) if len(found) else np.zeros(len(ref))
+        ious.extend(best.tolist())
+    ious = np.array(ious) if ious else np.ones(1)
+    return {
+        "images": len(images),
+        "faces": int(sum(len(b) for b in fp32_boxes)),
+        "box_iou_mean": float(ious.mean()),
+        "box_iou_min": float(ious.min()),
+        "count_mismatches": count_mismatches,
+        "fp32_latency_ms": fp32_ms / len(images),
+        "latency_ms": ms / len(images),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reduced-precision parity report.")
+    parser.add_argument("--image-dir", default=DEFAULT_FACES)
+    parser.add_argument("--precisions", nargs="+", choices=["bf16", "fp16"], default=["bf16", "fp16"])
+    parser.add_argument("--model", choices=["server", "android"], default="server")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--report", default="precision_report.json")
+    args = parser.parse_args()
+
+    if args.model == "android":
+        fp32_model = build_android_model()
+        # embed.py normalises to [-1, 1] with /127.5 rather than FaceProcessor's /128
+        rescale = 128.0 / 127.5
+    else:
+        fp32_model = build_fr_model()
+        rescale = 1.0
+
+    images = load_images(args.image_dir)
+    crops = aligned_crops(FaceProcessor(frozen=False), image_paths(args.image_dir)) * rescale
+    fp32_emb = embed(fp32_model, crops)
+    print(f"--- {len(images)} images, {len(crops)} aligned crops ---")
+
+    report = {"model": args.model, "threshold": args.threshold, "precisions": {}}
+    for precision in args.precisions:
+        dtype = precision_dtype(precision)
+        model = build_fr_model() if args.model == "server" else build_android_model()
+        model = model.to(dtype)
+        embedder = agreement_report(fp32_emb, embed(model, crops.to(dtype)), args.threshold)
+        embedder["fp32_latency_ms"] = latency_ms(fp32_model)
+        embedder["latency_ms"] = latency_ms(model, dtype=dtype)
+        embedder["speedup"] = embedder["fp32_latency_ms"] / embedder["latency_ms"]
+        report["precisions"][precision] = {
+            "detector": detector_report(images, precision),
+            "embedder": embedder,
+        }
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+quantize_model.py
+-----------------
+Post-training static int8 quantization of MobileFaceNet with an accuracy gate.
+
+1. FaceProcessor detects and aligns the faces in --calib-dir; the aligned
+   crops drive a per-channel int8 calibration pass.
+2. The int8 model is compared with fp32 on the crops in --eval-dir, or,
+   without it, on a fixed hold-out of --calib-dir (--eval-fraction of its
+   images, never used for calibration). Evaluation images must not also
+   be calibration images (compared by content):
+   * cosine agreement between each int8 embedding and its fp32 counterpart
+   * verification decision agreement at THRESHOLD over every crop pair
+3. The quantized TorchScript model is written only if the gate passes
+   (override with --force). A JSON report is written either way.
+
+Load the result with FaceProcessor(quantized=True) on the server, or with
+FACEAUTH_QUANTIZED=1 in the Android engine (--model android).
+
+Run with:
+    python quantize_model.py --calib-dir path/to/faces [--eval-dir path/to/other/faces]
+"""
+
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from api_server import THRESHOLD
+from face_processor import FR_INT8_WEIGHTS, PYENGINE_DIR, FaceProcessor, build_fr_model
+from facenet_pytorch.models.utils.quantize import load_quantized, quantize_static, save_quantized
+
+DEFAULT_FACES = os.path.join(PYENGINE_DIR, "facenet_pytorch", "data", "test_images")
+ANDROID_WEIGHTS = os.path.join(PYENGINE_DIR, "models", "MFN_AdaArcDistill_backbone.pth")
+ANDROID_INT8_WEIGHTS = os.path.join(PYENGINE_DIR, "models", "MFN_AdaArcDistill_backbone.int8.pt")
+
+
+def build_android_model():
+    """The GDC MobileFaceNet used by the Android engine's embed.py."""
+    from mobilefacenet import MobileFaceNet
+    net = MobileFaceNet(input_size=(112, 112), embedding_size=512, output_name="GDC")
+    ckpt = torch.load(ANDROID_WEIGHTS, map_location="cpu")
+    net.load_state_dict({k.replace("module.", ""): v for k, v in ckpt.items()})
+    return net.eval()
+
+
+def image_paths(image_dir):
+    """Sorted paths of the images under image_dir."""
+    return sorted(
+        p for ext in ("jpg", "jpeg", "png")
+        for p in glob.glob(os.path.join(image_dir, "**", f"*.{ext}"), recursive=True)
+    )
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def holdout_split(paths, fraction):
+    """
+    (calibration, evaluation) split of paths. Images are ordered by a hash
+    of their contents and the first `fraction` of them (at least one) are
+    held out, so the split does not depend on file names or order.
+    """
+    if len(paths) < 2:
+        raise RuntimeError("Need at least two images to hold out an evaluation set; pass --eval-dir")
+    ordered = sorted(paths, key=file_digest)
+    held_out = min(max(1, round(len(paths) * fraction)), len(paths) - 1)
+    return sorted(ordered[held_out:]), sorted(ordered[:held_out])
+
+
+def aligned_crops(processor, paths):
+    """Aligned, normalised 3x112x112 crops of every face FaceProcessor finds in paths."""
+    crops = []
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        face_tensor, _ = processor.get_aligned_face(img)
+        if face_tensor is not None:
+            crops.append(face_tensor[0])
+    if not crops:
+        raise RuntimeError(f"No faces found in {len(paths)} images")
+    return torch.stack(crops)
+
+
+def embed(model, crops, batch_size=32):
+    with torch.no_grad():
+        out = torch.cat([model(crops[i:i + batch_size]) for i in range(0, len(crops), batch_size)])
+    return torch.nn.functional.normalize(out.float(), dim=1).numpy()
+
+
+def latency_ms(model, repeat=30, dtype=torch.float32):
+    x = torch.zeros(1, 3, 112, 112, dtype=dtype)
+    with torch.no_grad():
+        for _ in range(5):
+            model(x)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(x)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def agreement_report(fp32_emb, int8_emb, threshold):
+    cosine = np.sum(fp32_emb * int8_emb, axis=1)
+    pairs = list(itertools.combinations(range(len(fp32_emb)), 2))
+    if pairs:
+        i, j = np.array(pairs).T
+        fp32_match = np.sum(fp32_emb[i] * fp32_emb[j], axis=1) >= threshold
+        int8_match = np.sum(int8_emb[i] * int8_emb[j], axis=1) >= threshold
+        decision_agreement = float(np.mean(fp32_match == int8_match))
+    else:
+        decision_agreement = 1.0
+    return {
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "cosine_p01": float(np.percentile(cosine, 1)),
+        "pairs": len(pairs),
+        "threshold": threshold,
+        "decision_agreement": decision_agreement,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize MobileFaceNet to int8.")
+    parser.add_argument("--calib-dir", default=DEFAULT_FACES, help="images used for calibration")
+    parser.add_argument("--eval-dir", default=None,
+                        help="images used for the report (default: a hold-out of calib-dir)")
+    parser.add_argument("--eval-fraction", type=float, default=0.3,
+                        help="share of calib-dir held out for the report when --eval-dir is not given")
+    parser.add_argument("--model", choices=["server", "android"], default="server")
+    parser.add_argument("--backend", choices=["x86", "qnnpack"], default=None,
+                        help="quantized engine (default: x86 for server, qnnpack for android)")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--min-cosine", type=float, default=0.98, help="gate on the minimum cosine")
+    parser.add_argument("--min-agreement", type=float, default=0.99, help="gate on decision agreement")
+    parser.add_argument("--report", default="quantization_report.json")
+    parser.add_argument("--force", action="store_true", help="write the model even if the gate fails")
+    args = parser.parse_args()
+
+    if args.model == "android":
+        fp32_model, output = build_android_model(), ANDROID_INT8_WEIGHTS
+        backend = args.backend or "qnnpack"
+        # embed.py normalises to [-1, 1] with /127.5 rather than FaceProcessor's /128
+        rescale = 128.0 / 127.5
+    else:
+        fp32_model, output = build_fr_model(), FR_INT8_WEIGHTS
+        backend = args.backend or "x86"
+        rescale = 1.0
+
+    if args.eval_dir is None:
+        calib_paths, eval_paths = holdout_split(image_paths(args.calib_dir), args.eval_fraction)
+    else:
+        calib_paths, eval_paths = image_paths(args.calib_dir), image_paths(args.eval_dir)
+        shared = {file_digest(p) for p in calib_paths} & {file_digest(p) for p in eval_paths}
+        if shared:
+            print(f"[QUANTIZE] {len(shared)} images are in both --calib-dir and --eval-dir; "
+                  "evaluate on images the model was not calibrated on.")
+            sys.exit(1)
+
+    processor = FaceProcessor(frozen=False)
+    calib = aligned_crops(processor, calib_paths) * rescale
+    evals = aligned_crops(processor, eval_paths) * rescale
+    print(f"--- {len(calib)} calibration crops, {len(evals)} evaluation crops ---")
+
+    int8_model = quantize_static(fp32_model, calib.split(16), backend=backend)
+
+    report = agreement_report(embed(fp32_model, evals), embed(int8_model, evals), args.threshold)
+    report.update({
+        "model": args.model,
+        "backend": backend,
+        "calibration_images": len(calib_paths),
+        "evaluation_images": len(eval_paths),
+        "calibration_crops": len(calib),
+        "evaluation_crops": len(evals),
+        "fp32_latency_ms": latency_ms(fp32_model),
+        "int8_latency_ms": latency_ms(int8_model),
+    })
+    report["speedup"] = report["fp32_latency_ms"] / report["int8_latency_ms"]
+    report["passed"] = (
+        report["cosine_min"] >= args.min_cosine and
+        report["decision_agreement"] >= args.min_agreement
+    )
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if not report["passed"] and not args.force:
+        print(f"[QUANTIZE] Accuracy gate failed; {output} not written.")
+        sys.exit(1)
+
+    save_quantized(int8_model, torch.zeros(1, 3, 112, 112), output)
+    # round-trip check of the serialized model
+    reloaded = embed(load_quantized(output), evals[:1])
+    assert np.allclose(reloaded, embed(int8_model, evals[:1]), atol=1e-4)
+    print(f"[QUANTIZE] int8 model written to {output}")
+
+
+if __name__ == "__main__":
+    main()